@@ -2,117 +2,556 @@ import asyncio
 from dotenv import load_dotenv
 from pymongo import AsyncMongoClient
 import os
-from utilities.fetch import fetch
+from utilities.fetch import fetch, fetch_pages
 from datetime import datetime
 from utilities.load_template import load_ongoing_template   
+from utilities.name_index import search_name_index, contains_name
+from utilities.watchlist import HISTORY_PROJECTION, build_watchlist, build_watchlist_from_names, load_watchlist_snapshot
+from utilities.text_similarity import get_similarity_hits, get_cjk_bigrams, get_cjk_similarity_hits
+from utilities.search_index import SEARCH_NGRAMS_REFRESHED_FIELD, get_unrefreshed_changelogs, mark_search_ngrams_refreshed, refresh_search_ngrams
+from utilities.result_cache import get_screening_invalidation_collection, ensure_screening_invalidation_index, publish_screening_invalidation
+from utilities.changelog_prefilter import PREFILTER_CHUNK_SIZE, PREFILTER_EN_NGRAM_SIZE, get_prefilter_keys, prefilter_changelog_ids
+from utilities.changelog_lease import LEASE_ID_FIELD, LeaseLostError, claim_changelog_pages, check_lease, complete_lease, renew_lease
 from rapidfuzz import fuzz
-import re
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from utilities.log import configure_logging, sample_debug
+from update_history_result import apply_ongoing_to_history_results
+from utilities.pipeline import run_pipeline
+from utilities.metrics import get_metrics, recorded_run, time_iterator
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
-async def namelist_after_similarity_check(name_en_list: list[str], name_zh_list: list[str], nameEN: str, nameZH: str):
-    match_name_en_list = []
-    match_name_zh_list = []
-    re_en_exp = re.compile(f".*{nameEN}.*")
-    re_zh_exp = re.compile(f".*{nameZH}.*")
+logger = logging.getLogger(__name__)
+
+MATCH_SHARDS_PER_WORKER = 4
+
+# Enough of a changelog to page through them and tell the prefiltered ones still to refresh
+CHANGELOG_PAGE_PROJECTION = {"category": 1, "action": 1, "new_data._id": 1, SEARCH_NGRAMS_REFRESHED_FIELD: 1}
+
+# The changelog fields needed to match, refresh search n-grams and invalidate cached screenings.
+# Matched changelogs are hydrated with the full document before the ongoing records are built.
+CHANGELOG_MATCH_PROJECTION = {
+    "category": 1,
+    "action": 1,
+    "status": 1,
+    "original_data_id": 1,
+    "new_data._id": 1,
+    "new_data.target": 1,
+    "new_data.title": 1,
+    "old_data.target": 1,
+    "old_data.title": 1,
+    SEARCH_NGRAMS_REFRESHED_FIELD: 1,
+}
+
+# The changelog fields an ongoing entry keeps when payloads are stored by reference
+CHANGELOG_REFERENCE_PROJECTION = {
+    "category": 1,
+    "action": 1,
+    "original_data_id": 1,
+    "new_data._id": 1,
+    "changes": 1,
+}
+
+def namelist_after_similarity_check(
+    name_en_list: list[str],
+    name_zh_list: list[str],
+    nameEN: str,
+    nameZH: str,
+    nameZH_bigrams: frozenset|None = None,
+    name_zh_bigrams_list: list[frozenset|None]|None = None
+):
+    candidate_name_en_list = []
     for name_en in name_en_list:
-        print(f"Comparing {name_en} with {nameEN}")
-        if re.search(re_en_exp, name_en) and len(name_en) > 0:
-            if fuzz.ratio(name_en, nameEN) > 20:
-                match_name_en_list.append(name_en)
-            
-    for name_zh in name_zh_list:
-        print(f"Comparing {name_zh} with {nameZH}")
-        if re.search(re_zh_exp, name_zh) and len(name_zh) > 0:
-            if fuzz.ratio(name_zh, nameZH) > 20:
-                match_name_zh_list.append(name_zh)
+        if sample_debug(logger):
+            logger.debug("Comparing %s with %s", name_en, nameEN)
+        if len(name_en) > 0 and contains_name(name_en, nameEN):
+            candidate_name_en_list.append(name_en)
+    
+    en_hits = get_similarity_hits([nameEN], candidate_name_en_list, threshold=20, threshold_type='>')
+    match_name_en_list = [candidate_name_en_list[choice_index] for _, choice_index, _ in en_hits]
+    
+    # Chinese names are compared on character bigrams, empty and single character names match nothing
+    if nameZH_bigrams is None:
+        nameZH_bigrams = get_cjk_bigrams(nameZH)
+    match_name_zh_list = []
+    if nameZH_bigrams:
+        if name_zh_bigrams_list is None:
+            name_zh_bigrams_list = [get_cjk_bigrams(name_zh) for name_zh in name_zh_list]
+        zh_hits = get_cjk_similarity_hits(nameZH_bigrams, name_zh_bigrams_list)
+        match_name_zh_list = [name_zh_list[choice_index] for choice_index, _ in zh_hits]
                 
     return match_name_en_list, match_name_zh_list
 
-async def cross_search_history_changelogs(history_data: list[dict], changelog_data: list[dict]) -> tuple[list[dict], list]:
-    results = []
+def title_after_similarity_check(title: str, nameEN: str, nameZH: str, nameZH_bigrams: frozenset|None = None) -> bool:
+    # As in namelist_after_similarity_check, empty and single character Chinese names match nothing
+    if nameZH_bigrams is None:
+        nameZH_bigrams = get_cjk_bigrams(nameZH)
+    if len(title) > 0 and len(nameEN) > 0 and contains_name(title, nameEN):
+        if fuzz.ratio(title, nameEN) > 20 or (nameZH_bigrams and fuzz.ratio(title, nameZH) > 20):
+            return True
+    elif len(title) > 0 and nameZH_bigrams and contains_name(title, nameZH):
+        if fuzz.ratio(title, nameZH) > 20:
+            return True
+    return False
+
+def get_changelog_names(changelog: dict) -> tuple|None:
+    """
+    Extract what the matching needs from a changelog:
+    ("adverse media", name_en_list, name_zh_list), ("judgment", title) or None
+    """
+    if changelog.get("category") == "adverse media":
+        if isinstance(changelog.get("new_data", {}).get("target"), list):
+            name_en_list = [item.get("name_en", "").lower() for item in changelog.get("new_data", {}).get("target", [])]
+            name_zh_list = [item.get("name_zh", "") for item in changelog.get("new_data", {}).get("target", [])]
+            return ("adverse media", name_en_list, name_zh_list)
+        elif isinstance(changelog.get("new_data", {}).get("target"), dict):
+            en = changelog.get("new_data", {}).get("target", {}).get("en", {})
+            zh = changelog.get("new_data", {}).get("target", {}).get("zh", {})
+            
+            name_en_list = [item.get("ceName", "").lower() for item in en]
+            name_zh_list = [item.get("ceName", "") for item in zh]
+            return ("adverse media", name_en_list, name_zh_list)
+                
+    elif changelog.get("category") == "judgment":
+        if isinstance(changelog.get("new_data"), dict):
+            title = changelog.get("new_data").get("title").lower()
+            if title:
+                return ("judgment", title)
+    return None
+
+def match_changelog_names(watchlist: dict, changelog_names: list[tuple|None], offset: int = 0, comparison_counts: list[int]|None = None) -> list[tuple[int, int]]:
+    """
+    Return the (history position, changelog position) pairs that match, with changelog
+    positions shifted by offset. The number of histories each changelog was scored against
+    is appended to comparison_counts when given.
+    """
+    name_en_history_list = watchlist["name_en_list"]
+    name_zh_history_list = watchlist["name_zh_list"]
+    zh_bigrams_history_list = watchlist["zh_bigrams"]
+    en_index = watchlist["en_index"]
+    zh_index = watchlist["zh_index"]
     
-    cartesian_product = []
-    for history in history_data: 
-        nameEN = history.get("nameEN", "").lower()
-        nameZH = history.get("nameZH", "")
-        for changelog in changelog_data:
-            if changelog.get("category") == "adverse media":
-                if isinstance(changelog.get("new_data", {}).get("target"), list):
-                    name_en_list = [item.get("name_en", "").lower() for item in changelog.get("new_data", {}).get("target", [])]
-                    name_zh_list = [item.get("name_zh", "") for item in changelog.get("new_data", {}).get("target", [])]
-                    match_name_en_list, match_name_zh_list = await namelist_after_similarity_check(name_en_list, name_zh_list, nameEN, nameZH)
-                    
-                    if match_name_en_list or match_name_zh_list:
-                        cartesian_product.append((history, changelog)) 
-                elif isinstance(changelog.get("new_data", {}).get("target"), dict):
-                    en = changelog.get("new_data", {}).get("target", {}).get("en", {})
-                    zh = changelog.get("new_data", {}).get("target", {}).get("zh", {})
-                    
-                    name_en_list = [item.get("ceName", "").lower() for item in en]
-                    name_zh_list = [item.get("ceName", "") for item in zh]     
-                    match_name_en_list, match_name_zh_list = await namelist_after_similarity_check(name_en_list, name_zh_list, nameEN, nameZH)
+    matched_pairs = []
+    for changelog_position, names in enumerate(changelog_names, offset):
+        if names is None:
+            if comparison_counts is not None:
+                comparison_counts.append(0)
+            continue
+        if names[0] == "adverse media":
+            _, name_en_list, name_zh_list = names
+            name_zh_bigrams_list = [get_cjk_bigrams(name_zh) for name_zh in name_zh_list]
+            candidates = set()
+            for name_en in name_en_list:
+                candidates.update(search_name_index(en_index, name_en))
+            for name_zh in name_zh_list:
+                candidates.update(search_name_index(zh_index, name_zh))
+            if comparison_counts is not None:
+                comparison_counts.append(len(candidates))
+            
+            for history_position in candidates:
+                match_name_en_list, match_name_zh_list = namelist_after_similarity_check(
+                    name_en_list, name_zh_list, name_en_history_list[history_position], name_zh_history_list[history_position],
+                    zh_bigrams_history_list[history_position], name_zh_bigrams_list
+                )
+                
+                if match_name_en_list or match_name_zh_list:
+                    matched_pairs.append((history_position, changelog_position))
                     
-                    if match_name_en_list or match_name_zh_list:
-                        cartesian_product.append((history, changelog))
-                        
-            elif changelog.get("category") == "judgment":
-                if isinstance(changelog.get("new_data"), dict):
-                    title = changelog.get("new_data").get("title").lower()
-                    if title:
-                        re_en_exp = re.compile(f".*{nameEN}.*")
-                        re_zh_exp = re.compile(f".*{nameZH}.*")
-                        if re.search(re_en_exp, title) and len(title) > 0 and len(nameEN) > 0:
-                            if fuzz.ratio(title, nameEN) > 20 or fuzz.ratio(title, nameZH) > 20:
-                                cartesian_product.append((history, changelog))
-                        elif re.search(re_zh_exp, title) and len(title) > 0 and len(nameZH) > 0:
-                            if fuzz.ratio(title, nameZH) > 20:
-                                cartesian_product.append((history, changelog))
+        elif names[0] == "judgment":
+            title = names[1]
+            candidates = search_name_index(en_index, title) | search_name_index(zh_index, title)
+            if comparison_counts is not None:
+                comparison_counts.append(len(candidates))
+            for history_position in candidates:
+                if title_after_similarity_check(
+                    title, name_en_history_list[history_position], name_zh_history_list[history_position],
+                    zh_bigrams_history_list[history_position]
+                ):
+                    matched_pairs.append((history_position, changelog_position))
+    return matched_pairs
+
+# Watchlist of a match worker process, built once by its initializer
+_worker_watchlist = None
+
+def init_match_worker(name_en_history_list: list[str], name_zh_history_list: list[str]):
+    global _worker_watchlist
+    _worker_watchlist = build_watchlist_from_names(name_en_history_list, name_zh_history_list)
+
+def match_changelog_shard(changelog_names: list[tuple|None], offset: int) -> tuple[list[tuple[int, int]], list[int]]:
+    comparison_counts = []
+    return match_changelog_names(_worker_watchlist, changelog_names, offset, comparison_counts), comparison_counts
+
+def create_match_executor(watchlist: dict, workers: int) -> ProcessPoolExecutor:
+    # Only the watchlist names are sent to the workers, once, and each worker rebuilds the index
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_match_worker,
+        initargs=(watchlist["name_en_list"], watchlist["name_zh_list"])
+    )
+
+async def match_changelog_names_in_executor(executor: ProcessPoolExecutor, workers: int, changelog_names: list[tuple|None], comparison_counts: list[int]|None = None) -> list[tuple[int, int]]:
+    loop = asyncio.get_running_loop()
+    # A few shards per worker keep the workers busy when some shards match more than others
+    shard_count = max(1, workers * MATCH_SHARDS_PER_WORKER)
+    shard_size = max(1, -(-len(changelog_names) // shard_count))
+    shards = await asyncio.gather(*[
+        loop.run_in_executor(executor, match_changelog_shard, changelog_names[start:start + shard_size], start)
+        for start in range(0, len(changelog_names), shard_size)
+    ])
+    if comparison_counts is not None:
+        comparison_counts.extend(count for _, shard_counts in shards for count in shard_counts)
+    return [pair for shard_pairs, _ in shards for pair in shard_pairs]
+
+async def hydrate_changelogs(collection, changelogs: list[dict], projection: dict|None = None) -> dict:
+    """
+    Load the full documents of projected changelogs, or the fields in projection, keyed by _id
+    """
+    documents = await collection.find({"_id": {"$in": [changelog['_id'] for changelog in changelogs]}}, projection).to_list()
+    return {document['_id']: document for document in documents}
+
+async def prefilter_changelog_page(
+    changelog_collection,
+    page: list[dict],
+    keys: dict,
+    search_collections: dict|None = None,
+    chunk_size: int = PREFILTER_CHUNK_SIZE,
+    lease_id=None
+) -> tuple[list[dict], list[dict]]:
+    """
+    Read the changelogs of a page, fetched with CHANGELOG_PAGE_PROJECTION, that contain a
+    watchlist key, with CHANGELOG_MATCH_PROJECTION. A leased page is the changelogs of its lease.
+
+    Returns:
+        The changelogs to match, and the changelogs whose source documents to refresh in
+        _id order: those to match and, with search_collections, the skipped ones not refreshed yet
+    """
+    if lease_id is not None:
+        condition = {LEASE_ID_FIELD: lease_id}
+    else:
+        condition = {"_id": {"$gte": page[0]['_id'], "$lte": page[-1]['_id']}, "status": "pending"}
+    candidate_ids = await prefilter_changelog_ids(changelog_collection, condition, keys, chunk_size)
+    # Skipped changelogs stay pending, only the ones not refreshed yet are read in full
+    read_ids = set(candidate_ids)
+    if search_collections:
+        read_ids.update(changelog['_id'] for changelog in get_unrefreshed_changelogs([changelog for changelog in page if changelog['_id'] not in candidate_ids]))
+    
+    refresh_data = []
+    if read_ids:
+        refresh_data = await changelog_collection.find({"_id": {"$in": list(read_ids)}}, CHANGELOG_MATCH_PROJECTION, sort=[("_id", 1)]).to_list()
+    changelog_data = [changelog for changelog in refresh_data if changelog['_id'] in candidate_ids]
+    logger.info("Prefilter kept %d of %d changelogs", len(changelog_data), len(page))
+    return changelog_data, refresh_data
+
+async def cross_search_history_changelogs(
+    history_data: list[dict],
+    changelog_data: list[dict],
+    watchlist: dict|None = None,
+    executor: ProcessPoolExecutor|None = None,
+    workers: int = 1,
+    hydrate_collection=None,
+    include_payloads: bool = True,
+    offload: bool = False
+) -> tuple[list[dict], list]:
+    results = []
+    
+    # The watchlist can be built once by the caller and reused across changelog batches
+    if watchlist is None:
+        watchlist = build_watchlist(history_data)
+    
+    metrics = get_metrics()
+    comparison_counts = []
+    with metrics.timer("match"):
+        changelog_names = [get_changelog_names(changelog) for changelog in changelog_data]
+        if executor is not None:
+            # Workers match shards of the batch against their copy of the watchlist
+            matched_pairs = await match_changelog_names_in_executor(executor, workers, changelog_names, comparison_counts)
+        elif offload:
+            # Match on a thread, so the event loop keeps reading and writing other batches
+            matched_pairs = await asyncio.to_thread(match_changelog_names, watchlist, changelog_names, 0, comparison_counts)
+        else:
+            matched_pairs = match_changelog_names(watchlist, changelog_names, 0, comparison_counts)
+    metrics.inc("pairs_compared", sum(comparison_counts))
+    metrics.observe("similarity_computations_per_changelog", comparison_counts)
 
+    if hydrate_collection is not None and matched_pairs:
+        # changelog_data was fetched with CHANGELOG_MATCH_PROJECTION, load the payloads of the matches only
+        matched_positions = sorted({changelog_position for _, changelog_position in matched_pairs})
+        with metrics.timer("hydrate"):
+            hydrated = await hydrate_changelogs(
+                hydrate_collection,
+                [changelog_data[position] for position in matched_positions],
+                None if include_payloads else CHANGELOG_REFERENCE_PROJECTION
+            )
+        changelog_data = list(changelog_data)
+        for position in matched_positions:
+            changelog_data[position] = hydrated.get(changelog_data[position]['_id'])
+        # Changelogs deleted in the meantime are dropped
+        matched_pairs = [pair for pair in matched_pairs if changelog_data[pair[1]] is not None]
+
+    metrics.inc("matches", len(matched_pairs))
+    
+    with metrics.timer("format"):
+        # Restore the history-major order of the full history x changelog scan
+        matched_pairs.sort()
+        cartesian_product = [(history_data[history_position], changelog_data[changelog_position]) for history_position, changelog_position in matched_pairs]
                 
-    cartesian_product.sort(key=lambda x: x[0]['_id'])
-    grouped = {}
-    for history, changelog in cartesian_product:
-        if history['_id'] not in grouped:
-            grouped[history['_id']] = {
-                'searchBy': history['searchBy'],
-                'changelogs': []
-            }
-        grouped[history['_id']]['changelogs'].append(changelog)
-
-    for history_id, data in grouped.items():
-        formatted = []
-        changelogs = data['changelogs']
-        for changelog in changelogs:
-            new_data = {
-                "sourcedata_changelogs_id": changelog['_id'],
-                "data_id": changelog.get("original_data_id") or str(changelog.get("new_data", {}).get("_id")) if changelog.get("new_data", {}).get("_id") else None,
-                'type': changelog['action'],
-                "category": changelog['category'],
-                "createdAt": datetime.now(),
-                "updatedAt": datetime.now(),
-                "new_data": changelog['new_data'],
-                "old_data": changelog['old_data']
-            }
+        cartesian_product.sort(key=lambda x: x[0]['_id'])
+        grouped = {}
+        for history, changelog in cartesian_product:
+            if history['_id'] not in grouped:
+                grouped[history['_id']] = {
+                    'searchBy': history['searchBy'],
+                    'changelogs': []
+                }
+            grouped[history['_id']]['changelogs'].append(changelog)
+
+        for history_id, data in grouped.items():
+            formatted = []
+            changelogs = data['changelogs']
+            for changelog in changelogs:
+                new_data = {
+                    "sourcedata_changelogs_id": changelog['_id'],
+                    "data_id": changelog.get("original_data_id") or str(changelog.get("new_data", {}).get("_id")) if changelog.get("new_data", {}).get("_id") else None,
+                    'type': changelog['action'],
+                    "category": changelog['category'],
+                    "createdAt": datetime.now(),
+                    "updatedAt": datetime.now(),
+                }
+                if include_payloads:
+                    new_data['new_data'] = changelog['new_data']
+                    new_data['old_data'] = changelog['old_data']
                 
-            if changelog['action'] == 'MOD':
-                new_data['changes'] = changelog['changes']
+                if changelog['action'] == 'MOD':
+                    new_data['changes'] = changelog['changes']
             
-            formatted.append(new_data)
+                formatted.append(new_data)
         
-        result = await load_ongoing_template()
-        result['aml_history_id'] = history_id
-        result['searchBy'] = data['searchBy']
-        result['data'] = formatted
-        result['createdAt'] = datetime.now()
-        result['updatedAt'] = datetime.now()
-        results.append(result)
+            result = await load_ongoing_template()
+            result['aml_history_id'] = history_id
+            result['searchBy'] = data['searchBy']
+            result['data'] = formatted
+            result['createdAt'] = datetime.now()
+            result['updatedAt'] = datetime.now()
+            results.append(result)
         
     return results, [product[1] for product in cartesian_product]
 
-async def main():
-    load_dotenv()
-    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
-    client = AsyncMongoClient(CONNECTION_STRING)
+def format_ongoing_audit(record: dict) -> dict:
+    # Same record without the article payloads, already applied to history_result
+    return {
+        **record,
+        "status": "done",
+        "data": [
+            {key: value for key, value in item.items() if key not in ("new_data", "old_data", "changes")}
+            for item in record.get("data", [])
+        ],
+    }
+
+def format_ongoing_reference(record: dict) -> dict:
+    # Same record without the article payloads, update_history_result reads them from the changelogs
+    return {
+        **record,
+        "data": [
+            {key: value for key, value in item.items() if key not in ("new_data", "old_data")}
+            for item in record.get("data", [])
+        ],
+    }
+
+async def load_checkpoint(collection, job_name: str):
+    checkpoint = await collection.find_one({"_id": job_name})
+    return checkpoint.get("last_id") if checkpoint else None
+
+async def save_checkpoint(collection, job_name: str, last_id, session=None):
+    await collection.update_one(
+        {"_id": job_name},
+        {"$set": {"last_id": last_id, "updatedAt": datetime.now()}},
+        upsert=True,
+        session=session
+    )
+
+async def clear_checkpoint(collection, job_name: str):
+    await collection.delete_one({"_id": job_name})
+
+async def supports_transactions(client: AsyncMongoClient) -> bool:
+    # Replica set members report their set name, mongos routers "isdbgrid"
+    hello = await client.admin.command("hello")
+    return bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+
+async def refresh_changed_sources(changelog_collection, changelog_data: list[dict], search_collections: dict, invalidation_collection=None) -> list[dict]:
+    """
+    Refresh the search n-grams and invalidate the cached screenings of the source documents
+    changed by the changelogs not seen yet, then mark those changelogs refreshed
+    """
+    changelogs = get_unrefreshed_changelogs(changelog_data)
+    if changelogs:
+        await refresh_search_ngrams(search_collections, changelogs)
+        if invalidation_collection is not None:
+            await publish_screening_invalidation(invalidation_collection, changelogs)
+        await mark_search_ngrams_refreshed(changelog_collection, changelogs)
+    return changelogs
+
+async def match_changelog_batch(
+    changelog_collection,
+    history_data: list[dict],
+    watchlist: dict,
+    changelog_data: list[dict],
+    search_collections: dict|None = None,
+    executor: ProcessPoolExecutor|None = None,
+    workers: int = 1,
+    projected: bool = False,
+    include_payloads: bool = True,
+    offload: bool = False,
+    invalidation_collection=None,
+    refresh_data: list[dict]|None = None
+) -> tuple[list[dict], list]:
+    """
+    Matching half of process_changelog_batch, returns the ongoing records and matched pairs.
+    The source documents of refresh_data, changelog_data by default, are refreshed first:
+    batches must come in _id order, so that the latest changelog of a document is applied last.
+    """
+    if search_collections:
+        # Keep the search n-grams and cached screenings of changed source documents up to date, once per changelog
+        with get_metrics().timer("search_ngrams"):
+            await refresh_changed_sources(
+                changelog_collection, changelog_data if refresh_data is None else refresh_data, search_collections, invalidation_collection
+            )
+    
+    # Result of cross search
+    return await cross_search_history_changelogs(
+        history_data, changelog_data, watchlist, executor, workers,
+        changelog_collection if projected else None,
+        include_payloads,
+        offload
+    )
+
+async def write_changelog_batch(
+    ongoing_collection,
+    changelog_collection,
+    changelog_data: list[dict],
+    aml_ongoing_monitoring_data: list[dict],
+    cartesian_product: list,
+    checkpoint_collection=None,
+    job_name: str|None = None,
+    use_transactions: bool = False,
+    history_result_collection=None,
+    history_result_batch_size: int = 1000,
+    last_id=None,
+    reference_payloads: bool = False,
+    lease_id=None
+) -> list[dict]:
+    """
+    Writing half of process_changelog_batch: ongoing records, changelog statuses and checkpoint
+    """
+    matched_ids = list(dict.fromkeys(product['_id'] for product in cartesian_product))
+    metrics = get_metrics()
+    apply_fused = history_result_collection is not None
+    
+    async def write_results(session=None):
+        if lease_id is not None:
+            # Changelogs claimed by another worker since the lease expired are its to write
+            await check_lease(changelog_collection, lease_id, matched_ids, session)
+        
+        ongoing_records = aml_ongoing_monitoring_data
+        if apply_fused and aml_ongoing_monitoring_data:
+            # Fused mode: apply the matches to history_result now and keep only an audit entry
+            # of the records that changed it, the others are written in full for update_history_result
+            for record in aml_ongoing_monitoring_data:
+                record.setdefault('_id', ObjectId())
+            applied_ongoing_ids = set()
+            await apply_ongoing_to_history_results(
+                history_result_collection, aml_ongoing_monitoring_data, history_result_batch_size, session,
+                applied_ongoing_ids=applied_ongoing_ids
+            )
+            ongoing_records = [
+                format_ongoing_audit(record) if record['_id'] in applied_ongoing_ids else record
+                for record in aml_ongoing_monitoring_data
+            ]
+        if reference_payloads:
+            ongoing_records = [format_ongoing_reference(record) for record in ongoing_records]
+        
+        if ongoing_records:
+            with metrics.timer("insert"):
+                await ongoing_collection.insert_many(ongoing_records, session=session)
+        
+        with metrics.timer("status_update"):
+            if lease_id is not None:
+                # Release the lease, matched changelogs are completed and the others pending again
+                await complete_lease(changelog_collection, lease_id, matched_ids, session)
+            elif matched_ids:
+                # Update changelog status to completed
+                await changelog_collection.update_many(
+                    {"_id": {"$in": matched_ids}},
+                    {"$set": {"status": "completed"}},
+                    session=session
+                )
+        
+        # A prefiltered page is done up to its last changelog, matched or not
+        checkpoint_id = last_id if last_id is not None else (changelog_data[-1]['_id'] if changelog_data else None)
+        if checkpoint_collection is not None and checkpoint_id is not None:
+            with metrics.timer("checkpoint"):
+                await save_checkpoint(checkpoint_collection, job_name, checkpoint_id, session)
     
+    if use_transactions:
+        # The ongoing records, status updates and checkpoint of a page are committed together,
+        # matching stays outside the transaction to keep it short
+        async with ongoing_collection.database.client.start_session() as session:
+            try:
+                await session.with_transaction(write_results)
+            except BulkWriteError as error:
+                if not apply_fused:
+                    raise
+                # The failed history_result write aborted the transaction, commit the page
+                # without applying it so that update_history_result retries its records
+                logger.error("Could not apply the page to history_result, writing its ongoing records in full: %s", error)
+                apply_fused = False
+                await session.with_transaction(write_results)
+    else:
+        await write_results()
+    # Counted once committed, a transaction may run write_results more than once
+    metrics.inc("ongoing_records_written", len(aml_ongoing_monitoring_data))
+    metrics.inc("changelogs_completed", len(matched_ids))
+    
+    logger.info("Matched %d of %d changelogs into %d ongoing records", len(matched_ids), len(changelog_data), len(aml_ongoing_monitoring_data))
+    return aml_ongoing_monitoring_data
+
+async def process_changelog_batch(
+    ongoing_collection,
+    changelog_collection,
+    history_data: list[dict],
+    watchlist: dict,
+    changelog_data: list[dict],
+    search_collections: dict|None = None,
+    executor: ProcessPoolExecutor|None = None,
+    workers: int = 1,
+    checkpoint_collection=None,
+    job_name: str|None = None,
+    use_transactions: bool = False,
+    history_result_collection=None,
+    history_result_batch_size: int = 1000,
+    projected: bool = False,
+    last_id=None,
+    reference_payloads: bool = False,
+    lease_id=None,
+    invalidation_collection=None
+) -> list[dict]:
+    # Fused mode applies the payloads right away, so it loads them even when they are stored by reference
+    aml_ongoing_monitoring_data, cartesian_product = await match_changelog_batch(
+        changelog_collection, history_data, watchlist, changelog_data, search_collections, executor, workers,
+        projected, not reference_payloads or history_result_collection is not None,
+        invalidation_collection=invalidation_collection
+    )
+    return await write_changelog_batch(
+        ongoing_collection, changelog_collection, changelog_data, aml_ongoing_monitoring_data, cartesian_product,
+        checkpoint_collection, job_name, use_transactions, history_result_collection, history_result_batch_size,
+        last_id, reference_payloads, lease_id
+    )
+
+@recorded_run("aml_ongoing_mon")
+async def run_ongoing_monitoring(client: AsyncMongoClient):
+    """
+    Match the pending changelogs against the watchlist once, with the given client
+    """
     source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
     media_collection_name = str(os.getenv("MEDIA_COLLECTION_NAME"))
     judgment_collection_name = str(os.getenv("JUDGMENT_COLLECTION_NAME"))
@@ -124,27 +563,169 @@ async def main():
     history_result_collection_name = str(os.getenv("HISTORY_RESULT_COLLECTION_NAME"))
     aml_ongoing_monitoring_collection_name = str(os.getenv("AML_ONGOING_MONITORING_COLLECTION_NAME"))
     
-    # Get data from AML_history by filter ongoing_monitoring = true
-    history_data = await fetch(client, test_db_name, history_collection_name, {"ongoing_monitoring": True})
+    changelog_batch_size = int(os.getenv("CHANGELOG_BATCH_SIZE", "1000"))
+    match_workers = int(os.getenv("MATCH_WORKERS", "1"))
+    watchlist_snapshot_path = os.getenv("WATCHLIST_SNAPSHOT_PATH")
+    checkpoint_collection_name = str(os.getenv("CHECKPOINT_COLLECTION_NAME", "aml_ongoing_monitoring_checkpoints"))
+    # Transactions need a replica set, without them a restart may repeat the last page.
+    # "auto" uses them when the deployment supports them, "true" or "false" forces the choice.
+    checkpoint_transactions = os.getenv("CHECKPOINT_TRANSACTIONS", "auto").lower()
+    # Fused mode also applies the matches to history_result, instead of update_history_result
+    fused = os.getenv("FUSED_HISTORY_RESULT", "false").lower() == "true"
+    history_result_batch_size = int(os.getenv("HISTORY_RESULT_BATCH_SIZE", "1000"))
+    # Let the server drop the changelogs that contain no watchlist key before they are read
+    prefilter = os.getenv("CHANGELOG_PREFILTER", "false").lower() == "true"
+    prefilter_chunk_size = int(os.getenv("PREFILTER_CHUNK_SIZE", str(PREFILTER_CHUNK_SIZE)))
+    prefilter_en_ngram_size = int(os.getenv("PREFILTER_EN_NGRAM_SIZE", str(PREFILTER_EN_NGRAM_SIZE)))
+    # Keep only changelog references in the ongoing records, not a copy of the payloads per history
+    reference_payloads = os.getenv("ONGOING_REFERENCE_PAYLOADS", "false").lower() == "true"
+    # Lease pages of changelogs so that several workers can run at once, instead of one checkpointed scan
+    use_leases = os.getenv("CHANGELOG_LEASES", "false").lower() == "true"
+    lease_seconds = float(os.getenv("CHANGELOG_LEASE_SECONDS", "300"))
+    # Pages waiting between two stages of the pipeline, which bounds the pages held in memory
+    pipeline_queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
     
-    # Get changelogs by filter status = pending
-    changelog_data = await fetch(client, source_db_name, sourcedata_changelogs_collection_name, {"status": "pending"})
+    if checkpoint_transactions == "auto":
+        use_transactions = await supports_transactions(client)
+        logger.info("Checkpoint transactions %s", "enabled" if use_transactions else "disabled, no replica set")
+    else:
+        use_transactions = checkpoint_transactions == "true"
     
-    # Result of cross search
-    aml_ongoing_monitoring_data, cartesian_product = await cross_search_history_changelogs(history_data, changelog_data)
+    metrics = get_metrics()
+    with metrics.timer("watchlist"):
+        if watchlist_snapshot_path:
+            # Start from the snapshot of the last run, refreshed with the histories updated since
+            history_data, watchlist = await load_watchlist_snapshot(client, test_db_name, history_collection_name, watchlist_snapshot_path)
+        else:
+            # Get data from AML_history by filter ongoing_monitoring = true
+            history_data = await fetch(client, test_db_name, history_collection_name, {"ongoing_monitoring": True}, HISTORY_PROJECTION)
+            watchlist = build_watchlist(history_data)
+    metrics.inc("watchlist_histories", len(history_data))
+    # Match on a process pool when more than one worker is configured
+    executor = create_match_executor(watchlist, match_workers) if match_workers > 1 else None
+    
+    search_collections = {
+        "adverse media": client[source_db_name][media_collection_name],
+        "judgment": client[source_db_name][judgment_collection_name],
+    }
     
-    if aml_ongoing_monitoring_data:
-        await client[test_db_name][aml_ongoing_monitoring_collection_name].insert_many(aml_ongoing_monitoring_data)
+    changelog_collection = client[source_db_name][sourcedata_changelogs_collection_name]
+    # Screenings cached by the API process are invalidated through this collection
+    invalidation_collection = get_screening_invalidation_collection(client[source_db_name])
+    await ensure_screening_invalidation_index(invalidation_collection)
+    checkpoint_collection = client[test_db_name][checkpoint_collection_name]
+    job_name = f"{source_db_name}.{sourcedata_changelogs_collection_name}"
+    prefilter_keys = get_prefilter_keys(watchlist, prefilter_en_ngram_size) if prefilter else None
+    page_projection = CHANGELOG_PAGE_PROJECTION if prefilter_keys is not None else CHANGELOG_MATCH_PROJECTION
     
-    if cartesian_product:
-        # Update changelog status to completed
-        await client[source_db_name][sourcedata_changelogs_collection_name].update_many(
-            {"_id": {"$in": [product['_id'] for product in cartesian_product]}},
-            {"$set": {"status": "completed"}}
+    # Fused mode applies the payloads right away, so it loads them even when they are stored by reference
+    include_payloads = not reference_payloads or fused
+    
+    async def keep_lease(page: list[dict], lease_id) -> bool:
+        # A leased page may wait in the queues longer than its lease, it is extended before each stage
+        if lease_id is None:
+            return True
+        try:
+            await renew_lease(changelog_collection, lease_id, len(page), lease_seconds)
+        except LeaseLostError as error:
+            metrics.inc("errors")
+            metrics.inc("leases_lost")
+            logger.warning("Skipping leased page: %s", error)
+            return False
+        return True
+    
+    async def read_page(item: tuple) -> tuple|None:
+        page, lease_id = item
+        if not await keep_lease(page, lease_id):
+            return None
+        metrics.inc("changelogs_scanned", len(page))
+        changelog_data = refresh_data = page
+        if prefilter_keys is not None:
+            with metrics.timer("prefilter"):
+                changelog_data, refresh_data = await prefilter_changelog_page(
+                    changelog_collection, page, prefilter_keys, search_collections, prefilter_chunk_size, lease_id
+                )
+            metrics.inc("changelogs_prefiltered_out", len(page) - len(changelog_data))
+        return page, lease_id, changelog_data, refresh_data
+    
+    async def match_page(item: tuple|None) -> tuple|None:
+        if item is None:
+            return None
+        page, lease_id, changelog_data, refresh_data = item
+        if not await keep_lease(page, lease_id):
+            return None
+        # Pages reach this stage one at a time and in order, so are their source documents refreshed.
+        # Without a process pool, matching runs on a thread so reading and writing go on meanwhile.
+        matched = await match_changelog_batch(
+            changelog_collection, history_data, watchlist, changelog_data, search_collections, executor, match_workers,
+            projected=True, include_payloads=include_payloads, offload=executor is None,
+            invalidation_collection=invalidation_collection, refresh_data=refresh_data
         )
+        return page, lease_id, changelog_data, matched
+    
+    async def write_page(item: tuple|None):
+        if item is None:
+            return
+        page, lease_id, changelog_data, (aml_ongoing_monitoring_data, cartesian_product) = item
+        if not await keep_lease(page, lease_id):
+            return
+        try:
+            await write_changelog_batch(
+                client[test_db_name][aml_ongoing_monitoring_collection_name],
+                changelog_collection,
+                changelog_data,
+                aml_ongoing_monitoring_data,
+                cartesian_product,
+                # Leases replace the checkpoint, an unfinished page is claimed again once its lease expires
+                checkpoint_collection if lease_id is None else None,
+                job_name,
+                use_transactions,
+                client[test_db_name][history_result_collection_name] if fused else None,
+                history_result_batch_size,
+                last_id=page[-1]['_id'],
+                reference_payloads=reference_payloads,
+                lease_id=lease_id
+            )
+        except LeaseLostError as error:
+            metrics.inc("errors")
+            metrics.inc("leases_lost")
+            logger.warning("Skipping leased page: %s", error)
     
-    # Close connection
-    await client.close()
+    # Pages are read, matched and written by separate tasks, each a few pages ahead of the next at most
+    stages = [("read", read_page), ("match", match_page), ("write", write_page)]
+    
+    try:
+        if use_leases:
+            # Several workers share the pending changelogs, each leasing one page at a time. Pages are
+            # claimed one ahead of each stage, the fewer leases wait in the queues the fewer expire there.
+            pages = time_iterator(claim_changelog_pages(changelog_collection, changelog_batch_size, lease_seconds, page_projection), "fetch")
+            await run_pipeline(((page, lease_id) async for lease_id, page in pages), stages, 1)
+        else:
+            # A run that died midway resumes after the last page it committed
+            last_id = await load_checkpoint(checkpoint_collection, job_name)
+            if last_id is not None:
+                logger.info("Resuming after changelog %s", last_id)
+        
+            # Get changelogs by filter status = pending, one _id-ordered page at a time
+            pages = time_iterator(fetch_pages(client, source_db_name, sourcedata_changelogs_collection_name, {"status": "pending"}, changelog_batch_size, last_id, page_projection), "fetch")
+            await run_pipeline(((page, None) async for page in pages), stages, pipeline_queue_size)
+        
+            # Unmatched changelogs stay pending, the next run scans them all again
+            await clear_checkpoint(checkpoint_collection, job_name)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+async def main():
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING)
+    try:
+        await run_ongoing_monitoring(client)
+    finally:
+        # Close connection
+        await client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,176 @@
+import asyncio
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+import os
+import json
+import random
+import signal
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable
+from aml_ongoing_mon import run_ongoing_monitoring
+from update_history_result import run_update_history_result
+from utilities.log import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Long-running entry point: one pooled client shared by both stages, each run on its own
+# interval with jitter, a /health endpoint and a graceful shutdown on SIGTERM or SIGINT.
+
+class ScheduledStage:
+    def __init__(self, name: str, run: Callable[[AsyncMongoClient], Awaitable], interval_seconds: float, jitter_seconds: float = 0):
+        self.name = name
+        self.run = run
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.last_started_at = None
+        self.last_finished_at = None
+        self.last_duration_seconds = None
+        self.last_error = None
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "overruns": self.overruns,
+            "interval_seconds": self.interval_seconds,
+            "last_started_at": self.last_started_at.isoformat() if self.last_started_at else None,
+            "last_finished_at": self.last_finished_at.isoformat() if self.last_finished_at else None,
+            "last_duration_seconds": self.last_duration_seconds,
+            "last_error": self.last_error,
+        }
+
+    def next_delay(self) -> float:
+        return max(0.0, self.interval_seconds + random.uniform(-self.jitter_seconds, self.jitter_seconds))
+
+async def run_stage_on_interval(stage: ScheduledStage, client: AsyncMongoClient, stop: asyncio.Event):
+    """
+    Run a stage until stop is set. A run is never started while the previous one is still
+    going, and the ticks missed by a long run are skipped rather than run back to back.
+    """
+    loop = asyncio.get_running_loop()
+    # Spread the first runs so the stages do not start together
+    next_run_at = loop.time() + random.uniform(0, stage.jitter_seconds)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), max(0.0, next_run_at - loop.time()))
+            break
+        except asyncio.TimeoutError:
+            pass
+
+        stage.running = True
+        stage.last_started_at = datetime.now()
+        started_at = loop.time()
+        try:
+            await stage.run(client)
+            stage.last_error = None
+        except Exception as error:
+            stage.failures += 1
+            stage.last_error = repr(error)
+            logger.exception("Stage %s failed", stage.name)
+        finally:
+            stage.running = False
+            stage.runs += 1
+            stage.last_finished_at = datetime.now()
+            stage.last_duration_seconds = loop.time() - started_at
+        logger.info("Stage %s finished in %.1fs", stage.name, stage.last_duration_seconds)
+
+        next_run_at = started_at + stage.next_delay()
+        if next_run_at < loop.time():
+            stage.overruns += 1
+            logger.warning("Stage %s overran its interval, next run in a full interval", stage.name)
+            next_run_at = loop.time() + stage.next_delay()
+
+async def get_health(client: AsyncMongoClient, stages: list[ScheduledStage]) -> tuple[int, dict]:
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), 5)
+        database = "ok"
+    except Exception as error:
+        database = repr(error)
+    healthy = database == "ok"
+    return (200 if healthy else 503), {
+        "status": "ok" if healthy else "unavailable",
+        "database": database,
+        "stages": {stage.name: stage.status() for stage in stages},
+    }
+
+async def start_health_server(host: str, port: int, client: AsyncMongoClient, stages: list[ScheduledStage]) -> asyncio.Server:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), 5)).decode(errors="replace").split()
+            # Drain the request headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request_line[1] if len(request_line) > 1 else ""
+            if path in ("/health", "/status"):
+                code, body = await get_health(client, stages)
+            else:
+                code, body = 404, {"error": "not found"}
+            payload = json.dumps(body).encode()
+            reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[code]
+            writer.write(f"HTTP/1.1 {code} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def serve(
+    client: AsyncMongoClient,
+    stages: list[ScheduledStage],
+    health_host: str = "0.0.0.0",
+    health_port: int = 8080,
+    shutdown_timeout_seconds: float = 60
+):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = await start_health_server(health_host, health_port, client, stages)
+    logger.info("Serving health on %s:%d with stages %s", health_host, health_port, ", ".join(stage.name for stage in stages))
+    tasks = [asyncio.create_task(run_stage_on_interval(stage, client, stop)) for stage in stages]
+    try:
+        await stop.wait()
+        logger.info("Shutting down, waiting up to %.0fs for running stages", shutdown_timeout_seconds)
+        # Running stages finish their current run, the checkpoints cover the rest
+        done, pending = await asyncio.wait(tasks, timeout=shutdown_timeout_seconds)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+async def main():
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING, maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")))
+
+    jitter_seconds = float(os.getenv("SERVICE_JITTER_SECONDS", "30"))
+    stages = [
+        ScheduledStage("ongoing_monitoring", run_ongoing_monitoring, float(os.getenv("ONGOING_MONITORING_INTERVAL_SECONDS", "300")), jitter_seconds),
+        ScheduledStage("update_history_result", run_update_history_result, float(os.getenv("UPDATE_HISTORY_RESULT_INTERVAL_SECONDS", "300")), jitter_seconds),
+    ]
+    try:
+        await serve(
+            client,
+            stages,
+            health_host=os.getenv("HEALTH_HOST", "0.0.0.0"),
+            health_port=int(os.getenv("HEALTH_PORT", "8080")),
+            shutdown_timeout_seconds=float(os.getenv("SHUTDOWN_TIMEOUT_SECONDS", "60"))
+        )
+    finally:
+        # Close connection
+        await client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,175 @@
+import asyncio
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+from pymongo.errors import OperationFailure
+import os
+from datetime import datetime
+import logging
+from utilities.fetch import fetch, fetch_batches
+from concurrent.futures import ProcessPoolExecutor
+from aml_ongoing_mon import CHANGELOG_MATCH_PROJECTION, create_match_executor, process_changelog_batch
+from utilities.watchlist import HISTORY_PROJECTION, build_watchlist, load_watchlist_snapshot
+from utilities.result_cache import get_screening_invalidation_collection, ensure_screening_invalidation_index
+from utilities.log import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Changelogs that become pending, either newly inserted or reset by an update
+CHANGELOG_PIPELINE = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": "insert", "fullDocument.status": "pending"},
+                {"operationType": "update", "updateDescription.updatedFields.status": "pending"},
+                {"operationType": "replace", "fullDocument.status": "pending"},
+            ]
+        }
+    },
+    {"$project": {"documentKey": 1, "operationType": 1}}
+]
+
+# Server error code for a resume token that is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+async def load_resume_token(collection, stream_name: str):
+    state = await collection.find_one({"_id": stream_name})
+    return state.get("resume_token") if state else None
+
+async def save_resume_token(collection, stream_name: str, resume_token):
+    await collection.update_one(
+        {"_id": stream_name},
+        {"$set": {"resume_token": resume_token, "updatedAt": datetime.now()}},
+        upsert=True
+    )
+
+async def load_watchlist(client: AsyncMongoClient, database_name: str, collection_name: str, workers: int = 1, snapshot_path: str|None = None) -> tuple[list[dict], dict, ProcessPoolExecutor|None]:
+    if snapshot_path:
+        history_data, watchlist = await load_watchlist_snapshot(client, database_name, collection_name, snapshot_path)
+    else:
+        history_data = await fetch(client, database_name, collection_name, {"ongoing_monitoring": True}, HISTORY_PROJECTION)
+        watchlist = build_watchlist(history_data)
+    executor = create_match_executor(watchlist, workers) if workers > 1 else None
+    return history_data, watchlist, executor
+
+async def flush_changelogs(ongoing_collection, changelog_collection, history_data: list[dict], watchlist: dict, changelog_ids: list, search_collections: dict|None = None, executor: ProcessPoolExecutor|None = None, workers: int = 1, reference_payloads: bool = False, invalidation_collection=None):
+    # Re-read by id so changelogs already handled by another run are not matched twice
+    changelog_data = await changelog_collection.find({"_id": {"$in": changelog_ids}, "status": "pending"}, CHANGELOG_MATCH_PROJECTION).to_list()
+    if changelog_data:
+        await process_changelog_batch(ongoing_collection, changelog_collection, history_data, watchlist, changelog_data, search_collections, executor, workers, projected=True, reference_payloads=reference_payloads, invalidation_collection=invalidation_collection)
+    logger.info("Processed %d of %d changelogs from change stream", len(changelog_data), len(changelog_ids))
+
+async def watch_changelogs(
+    client: AsyncMongoClient,
+    source_db_name: str,
+    sourcedata_changelogs_collection_name: str,
+    test_db_name: str,
+    history_collection_name: str,
+    aml_ongoing_monitoring_collection_name: str,
+    resume_token_collection_name: str,
+    batch_size: int = 100,
+    flush_seconds: float = 2,
+    watchlist_refresh_seconds: float = 300,
+    search_collections: dict|None = None,
+    workers: int = 1,
+    watchlist_snapshot_path: str|None = None,
+    reference_payloads: bool = False
+):
+    changelog_collection = client[source_db_name][sourcedata_changelogs_collection_name]
+    ongoing_collection = client[test_db_name][aml_ongoing_monitoring_collection_name]
+    resume_token_collection = client[test_db_name][resume_token_collection_name]
+    # Screenings cached by the API process are invalidated through this collection
+    invalidation_collection = get_screening_invalidation_collection(client[source_db_name])
+    await ensure_screening_invalidation_index(invalidation_collection)
+    stream_name = f"{source_db_name}.{sourcedata_changelogs_collection_name}"
+    loop = asyncio.get_running_loop()
+
+    history_data, watchlist, executor = await load_watchlist(client, test_db_name, history_collection_name, workers, watchlist_snapshot_path)
+    watchlist_loaded_at = loop.time()
+    resume_token = await load_resume_token(resume_token_collection, stream_name)
+
+    while True:
+        try:
+            stream = await changelog_collection.watch(CHANGELOG_PIPELINE, start_after=resume_token, max_await_time_ms=int(flush_seconds * 1000))
+        except OperationFailure as error:
+            if error.code != CHANGE_STREAM_HISTORY_LOST or resume_token is None:
+                raise
+            logger.warning("Resume token is no longer available, restarting change stream: %s", error)
+            resume_token = None
+            continue
+
+        async with stream:
+            if resume_token is None:
+                # Nothing recorded yet, catch up on the backlog that is already pending
+                async for changelog_data in fetch_batches(client, source_db_name, sourcedata_changelogs_collection_name, {"status": "pending"}, batch_size, CHANGELOG_MATCH_PROJECTION):
+                    await process_changelog_batch(ongoing_collection, changelog_collection, history_data, watchlist, changelog_data, search_collections, executor, workers, projected=True, reference_payloads=reference_payloads, invalidation_collection=invalidation_collection)
+                resume_token = stream.resume_token
+                await save_resume_token(resume_token_collection, stream_name, resume_token)
+
+            changelog_ids = []
+            batch_started_at = None
+            while stream.alive:
+                change = await stream.try_next()
+                if change is not None:
+                    changelog_ids.append(change["documentKey"]["_id"])
+                    if batch_started_at is None:
+                        batch_started_at = loop.time()
+
+                if changelog_ids and (len(changelog_ids) >= batch_size or loop.time() - batch_started_at >= flush_seconds):
+                    await flush_changelogs(ongoing_collection, changelog_collection, history_data, watchlist, changelog_ids, search_collections, executor, workers, reference_payloads, invalidation_collection)
+                    changelog_ids = []
+                    batch_started_at = None
+
+                # Only move the resume token past changes that have been flushed
+                if not changelog_ids and stream.resume_token != resume_token:
+                    resume_token = stream.resume_token
+                    await save_resume_token(resume_token_collection, stream_name, resume_token)
+
+                if loop.time() - watchlist_loaded_at >= watchlist_refresh_seconds:
+                    # Match workers hold their own copy of the watchlist, replace them with it
+                    if executor is not None:
+                        executor.shutdown()
+                    history_data, watchlist, executor = await load_watchlist(client, test_db_name, history_collection_name, workers, watchlist_snapshot_path)
+                    watchlist_loaded_at = loop.time()
+
+async def main():
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING)
+
+    source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
+    media_collection_name = str(os.getenv("MEDIA_COLLECTION_NAME"))
+    judgment_collection_name = str(os.getenv("JUDGMENT_COLLECTION_NAME"))
+    sourcedata_changelogs_collection_name = str(os.getenv("SOURCEDATA_CHANGELOGS_COLLECTION_NAME"))
+
+    test_db_name = str(os.getenv("TEST_DATABASE_NAME"))
+    history_collection_name = str(os.getenv("HISTORY_COLLECTION_NAME"))
+    aml_ongoing_monitoring_collection_name = str(os.getenv("AML_ONGOING_MONITORING_COLLECTION_NAME"))
+    resume_token_collection_name = str(os.getenv("RESUME_TOKEN_COLLECTION_NAME", "aml_ongoing_monitoring_resume_tokens"))
+
+    try:
+        await watch_changelogs(
+            client,
+            source_db_name,
+            sourcedata_changelogs_collection_name,
+            test_db_name,
+            history_collection_name,
+            aml_ongoing_monitoring_collection_name,
+            resume_token_collection_name,
+            batch_size=int(os.getenv("WATCH_BATCH_SIZE", "100")),
+            flush_seconds=float(os.getenv("WATCH_FLUSH_SECONDS", "2")),
+            watchlist_refresh_seconds=float(os.getenv("WATCHLIST_REFRESH_SECONDS", "300")),
+            search_collections={
+                "adverse media": client[source_db_name][media_collection_name],
+                "judgment": client[source_db_name][judgment_collection_name],
+            },
+            workers=int(os.getenv("MATCH_WORKERS", "1")),
+            watchlist_snapshot_path=os.getenv("WATCHLIST_SNAPSHOT_PATH"),
+            reference_payloads=os.getenv("ONGOING_REFERENCE_PAYLOADS", "false").lower() == "true"
+        )
+    finally:
+        # Close connection
+        await client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,317 @@
+import copy
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+
+# Stand-ins for the AsyncMongoClient objects used by the jobs. They support the
+# queries and writes the jobs issue: equality, comparisons, $in, $exists, $or, $expr
+# comparisons, $set and $unset updates and pipelines, the InsertOne/UpdateOne/DeleteOne
+# bulk operations, and the server time of hello.
+
+def server_now() -> datetime:
+    # Dates come back from the server as naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+EXPRESSION_COMPARISONS = {
+    "$lt": lambda left, right: left < right,
+    "$lte": lambda left, right: left <= right,
+    "$gt": lambda left, right: left > right,
+    "$gte": lambda left, right: left >= right,
+}
+
+def evaluate(document: dict, expression, now: datetime):
+    """
+    The value of an aggregation expression: field paths, $$NOW, $literal, $add of a date
+    and milliseconds, and comparisons, where a missing value sorts before any other
+    """
+    if isinstance(expression, str) and expression == "$$NOW":
+        return now
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = document
+        for part in expression[1:].split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, operand = next(iter(expression.items()))
+        if operator == "$literal":
+            return operand
+        if operator == "$add":
+            values = [evaluate(document, item, now) for item in operand]
+            dates = [value for value in values if isinstance(value, datetime)]
+            milliseconds = sum(value for value in values if not isinstance(value, datetime))
+            return dates[0] + timedelta(milliseconds=milliseconds) if dates else milliseconds
+        if operator in EXPRESSION_COMPARISONS:
+            left, right = (evaluate(document, item, now) for item in operand)
+            if left is None or right is None:
+                return EXPRESSION_COMPARISONS[operator](left is not None, right is not None)
+            return EXPRESSION_COMPARISONS[operator](left, right)
+    return expression
+
+def matches(document: dict, condition: dict) -> bool:
+    for key, expected in condition.items():
+        if key == "$or":
+            if not any(matches(document, sub_condition) for sub_condition in expected):
+                return False
+            continue
+        if key == "$expr":
+            if not evaluate(document, expected, server_now()):
+                return False
+            continue
+        value = document
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if isinstance(expected, dict) and expected and all(operator.startswith("$") for operator in expected):
+            for operator, operand in expected.items():
+                if operator == "$in" and value not in operand:
+                    return False
+                if operator == "$nin" and value in operand:
+                    return False
+                if operator == "$exists" and (value is not None) != operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$gt" and not (value is not None and value > operand):
+                    return False
+                if operator == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if operator == "$lt" and not (value is not None and value < operand):
+                    return False
+                if operator == "$lte" and not (value is not None and value <= operand):
+                    return False
+        elif value != expected:
+            return False
+    return True
+
+def prepare(condition: dict|None) -> dict:
+    # Turn $in lists into sets once so large $in conditions stay cheap per document
+    prepared = {}
+    for key, expected in (condition or {}).items():
+        if key == "$or":
+            prepared[key] = [prepare(sub_condition) for sub_condition in expected]
+        elif isinstance(expected, dict) and isinstance(expected.get("$in"), list):
+            try:
+                prepared[key] = {**expected, "$in": frozenset(expected["$in"])}
+            except TypeError:
+                prepared[key] = expected
+        else:
+            prepared[key] = expected
+    return prepared
+
+def project(document: dict, projection: dict|None) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = [key for key, flag in projection.items() if flag]
+    if included:
+        projected = {}
+        for key in included:
+            # Dotted paths keep the enclosing documents, like a server-side projection
+            *parents, leaf = key.split(".")
+            source, target = document, projected
+            for part in parents:
+                source = source.get(part) if isinstance(source, dict) else None
+                if not isinstance(source, dict):
+                    break
+                target = target.setdefault(part, {})
+            else:
+                if isinstance(source, dict) and leaf in source:
+                    target[leaf] = copy.deepcopy(source[leaf])
+        if projection.get("_id", 1):
+            projected["_id"] = document["_id"]
+        return projected
+    return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+
+def apply_update(document: dict, update: dict|list):
+    if isinstance(update, list):
+        # An update pipeline of $set and $unset stages
+        now = server_now()
+        for stage in update:
+            for key, value in stage.get("$set", {}).items():
+                document[key] = evaluate(document, value, now)
+            unset = stage.get("$unset", [])
+            for key in [unset] if isinstance(unset, str) else unset:
+                document.pop(key, None)
+        return
+    for key, value in update.get("$set", {}).items():
+        document[key] = value
+    for key in update.get("$unset", {}):
+        document.pop(key, None)
+
+class InMemoryCursor:
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    async def to_list(self, length: int|None = None) -> list[dict]:
+        return self.documents[:length] if length else list(self.documents)
+
+    def __aiter__(self):
+        self.iterator = iter(self.documents)
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+# Values of different types sort by type first, as in BSON, with missing values first
+SORT_TYPE_ORDER = {type(None): 0, int: 1, float: 1, str: 2, ObjectId: 3, datetime: 4}
+
+def sort_key(value) -> tuple:
+    return (SORT_TYPE_ORDER.get(type(value), len(SORT_TYPE_ORDER)), value)
+
+class InMemoryCollection:
+    def __init__(self, name: str, database=None):
+        self.name = name
+        self.database = database
+        self.documents = {}
+        # Sort keys of the _ids in order, which _id-ordered pages are read from like an index
+        self.id_keys = []
+
+    def candidates(self, condition: dict|None) -> list[dict]:
+        # Primary key lookups avoid scanning the whole collection
+        _id = (condition or {}).get("_id")
+        if isinstance(_id, dict) and "$in" in _id:
+            return [self.documents[value] for value in _id["$in"] if value in self.documents]
+        if _id is not None and not isinstance(_id, dict):
+            return [self.documents[_id]] if _id in self.documents else []
+        return list(self.documents.values())
+
+    def scan_in_id_order(self, condition: dict|None):
+        # Start after the _id bound of a page condition instead of at the first document
+        bound = (condition or {}).get("_id")
+        start = 0
+        if isinstance(bound, dict) and "$gt" in bound:
+            start = bisect_right(self.id_keys, sort_key(bound["$gt"]))
+        elif isinstance(bound, dict) and "$gte" in bound:
+            start = bisect_left(self.id_keys, sort_key(bound["$gte"]))
+        for position in range(start, len(self.id_keys)):
+            yield self.documents[self.id_keys[position][1]]
+
+    def find(self, condition: dict|None = None, projection: dict|None = None, sort: list|None = None, limit: int = 0, **kwargs) -> InMemoryCursor:
+        prepared = prepare(condition)
+        _id = (condition or {}).get("_id")
+        if list(sort or []) == [("_id", 1)] and (_id is None or isinstance(_id, dict) and "$in" not in _id):
+            # Matches come in order, stop at the limit
+            found = []
+            for document in self.scan_in_id_order(condition):
+                if matches(document, prepared):
+                    found.append(document)
+                    if len(found) == limit:
+                        break
+        else:
+            found = [document for document in self.candidates(condition) if matches(document, prepared)]
+            for key, direction in reversed(sort or []):
+                found.sort(key=lambda document: sort_key(document.get(key)), reverse=direction < 0)
+            if limit:
+                found = found[:limit]
+        # Only the returned documents are copied
+        return InMemoryCursor([project(document, projection) for document in found])
+
+    async def find_one(self, condition: dict|None = None, projection: dict|None = None, **kwargs) -> dict|None:
+        found = await self.find(condition, projection).to_list(1)
+        return found[0] if found else None
+
+    async def count_documents(self, condition: dict, **kwargs) -> int:
+        prepared = prepare(condition)
+        return sum(1 for document in self.candidates(condition) if matches(document, prepared))
+
+    async def insert_one(self, document: dict):
+        document.setdefault("_id", ObjectId())
+        if document["_id"] not in self.documents:
+            insort(self.id_keys, sort_key(document["_id"]))
+        self.documents[document["_id"]] = copy.deepcopy(document)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def insert_many(self, documents: list[dict], ordered: bool = True, **kwargs):
+        for document in documents:
+            await self.insert_one(document)
+        return SimpleNamespace(inserted_ids=[document["_id"] for document in documents])
+
+    async def update_one(self, condition: dict, update: dict, upsert: bool = False, **kwargs):
+        for document in self.candidates(condition):
+            if matches(document, condition):
+                apply_update(document, update)
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            document = {key: value for key, value in condition.items() if not key.startswith("$")}
+            apply_update(document, update)
+            await self.insert_one(document)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=document["_id"])
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, condition: dict, update: dict, **kwargs):
+        modified = 0
+        prepared = prepare(condition)
+        for document in self.candidates(condition):
+            if matches(document, prepared):
+                apply_update(document, update)
+                modified += 1
+        return SimpleNamespace(matched_count=modified, modified_count=modified)
+
+    def remove(self, _id):
+        del self.documents[_id]
+        del self.id_keys[bisect_left(self.id_keys, sort_key(_id))]
+
+    async def delete_one(self, condition: dict, **kwargs):
+        for document in self.candidates(condition):
+            if matches(document, condition):
+                self.remove(document["_id"])
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    async def delete_many(self, condition: dict, **kwargs):
+        prepared = prepare(condition)
+        deleted = [document["_id"] for document in self.candidates(condition) if matches(document, prepared)]
+        for _id in deleted:
+            self.remove(_id)
+        return SimpleNamespace(deleted_count=len(deleted))
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs):
+        inserted = modified = deleted = 0
+        for request in requests:
+            if isinstance(request, InsertOne):
+                await self.insert_one(request._doc)
+                inserted += 1
+            elif isinstance(request, UpdateOne):
+                modified += (await self.update_one(request._filter, request._doc)).modified_count
+            elif isinstance(request, DeleteOne):
+                deleted += (await self.delete_many(request._filter)).deleted_count
+        return SimpleNamespace(inserted_count=inserted, modified_count=modified, deleted_count=deleted)
+
+    async def create_index(self, keys, **kwargs):
+        return keys if isinstance(keys, str) else "_".join(key for key, _ in keys)
+
+class InMemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, collection_name: str) -> InMemoryCollection:
+        if collection_name not in self.collections:
+            self.collections[collection_name] = InMemoryCollection(collection_name, self)
+        return self.collections[collection_name]
+
+    async def command(self, command: str, **kwargs) -> dict:
+        if command != "hello":
+            raise NotImplementedError(command)
+        return {"isWritablePrimary": True, "localTime": server_now()}
+
+class InMemoryClient:
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, database_name: str) -> InMemoryDatabase:
+        if database_name not in self.databases:
+            self.databases[database_name] = InMemoryDatabase(database_name)
+        return self.databases[database_name]
+
+    async def close(self):
+        pass
@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from aml_ongoing_mon import run_ongoing_monitoring
+from update_history_result import group_ongoing_by_history, add_history_results_to_group, handle_group, resolve_ongoing_payloads
+from utilities.fetch import fetch, fetch_batches
+from utilities.metrics import record_run
+from benchmarks.in_memory_collection import InMemoryClient
+from benchmarks.synthetic_data import generate_dataset
+
+# Runs the matching (aml_ongoing_mon) and grouping (update_history_result) stages on
+# synthetic data held in in-memory collections, and reports per-stage timings,
+# throughput and peak RSS.
+#
+#   python -m benchmarks.run_benchmark --histories 10000 --changelogs 100000
+
+SOURCE_DB_NAME = "sourcedata"
+TEST_DB_NAME = "aml"
+SOURCEDATA_CHANGELOGS_COLLECTION_NAME = "sourcedata_changelogs"
+MEDIA_COLLECTION_NAME = "adverse_media"
+JUDGMENT_COLLECTION_NAME = "judgment"
+HISTORY_COLLECTION_NAME = "AML_history"
+HISTORY_RESULT_COLLECTION_NAME = "history_result"
+AML_ONGOING_MONITORING_COLLECTION_NAME = "aml_ongoing_monitoring"
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+            stage["seconds"] += time.perf_counter() - started_at
+            stage["calls"] += 1
+            stage["items"] += items
+            stage["peak_rss_mb"] = get_peak_rss_mb()
+
+    def add_items(self, name: str, items: int):
+        self.stages[name]["items"] += items
+
+    def add_stage(self, name: str, seconds: float, calls: int, items: int = 0):
+        # A stage timed by the job's own metrics
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "items": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+        stage["items"] += items
+        stage["peak_rss_mb"] = get_peak_rss_mb()
+
+async def run_matching(client: InMemoryClient, timer: StageTimer, batch_size: int, match_workers: int = 1, watchlist_snapshot_path: str|None = None, reference_payloads: bool = False) -> dict:
+    """
+    Run the monitoring job itself, with its read/match/write pipeline, and report the stages
+    it recorded. The in-memory collections have no sessions, so checkpoints are not transactional.
+    """
+    os.environ.update({
+        "SOURCE_DATABASE_NAME": SOURCE_DB_NAME,
+        "SOURCEDATA_CHANGELOGS_COLLECTION_NAME": SOURCEDATA_CHANGELOGS_COLLECTION_NAME,
+        "MEDIA_COLLECTION_NAME": MEDIA_COLLECTION_NAME,
+        "JUDGMENT_COLLECTION_NAME": JUDGMENT_COLLECTION_NAME,
+        "TEST_DATABASE_NAME": TEST_DB_NAME,
+        "HISTORY_COLLECTION_NAME": HISTORY_COLLECTION_NAME,
+        "HISTORY_RESULT_COLLECTION_NAME": HISTORY_RESULT_COLLECTION_NAME,
+        "AML_ONGOING_MONITORING_COLLECTION_NAME": AML_ONGOING_MONITORING_COLLECTION_NAME,
+        "CHANGELOG_BATCH_SIZE": str(batch_size),
+        "MATCH_WORKERS": str(match_workers),
+        "ONGOING_REFERENCE_PAYLOADS": "true" if reference_payloads else "false",
+        "CHECKPOINT_TRANSACTIONS": "false",
+    })
+    if watchlist_snapshot_path:
+        os.environ["WATCHLIST_SNAPSHOT_PATH"] = watchlist_snapshot_path
+    else:
+        os.environ.pop("WATCHLIST_SNAPSHOT_PATH", None)
+
+    # The undecorated job records into the benchmark's run instead of exporting its own
+    async with record_run("benchmark") as metrics:
+        await run_ongoing_monitoring.__wrapped__(client)
+
+    scanned = int(metrics.counters.get("changelogs_scanned", 0))
+    ongoing_records = int(metrics.counters.get("ongoing_records_written", 0))
+    items = {"fetch": scanned, "match": scanned, "insert": ongoing_records, "status_update": int(metrics.counters.get("changelogs_completed", 0))}
+    for stage, seconds in metrics.stage_seconds.items():
+        timer.add_stage(f"matching.{stage}", seconds, metrics.stage_calls[stage], items.get(stage, 0))
+
+    ongoing_entries = 0
+    async for record in client[TEST_DB_NAME][AML_ONGOING_MONITORING_COLLECTION_NAME].find({}, {"data": 1}):
+        ongoing_entries += len(record.get("data", []))
+    return {
+        "changelogs_scanned": scanned,
+        "history_changelog_matches": int(metrics.counters.get("matches", 0)),
+        "ongoing_records": ongoing_records,
+        "ongoing_entries": ongoing_entries,
+    }
+
+async def run_grouping(client: InMemoryClient, timer: StageTimer, batch_size: int) -> dict:
+    ongoing_collection = client[TEST_DB_NAME][AML_ONGOING_MONITORING_COLLECTION_NAME]
+    history_result_collection = client[TEST_DB_NAME][HISTORY_RESULT_COLLECTION_NAME]
+    changelog_collection = client[SOURCE_DB_NAME][SOURCEDATA_CHANGELOGS_COLLECTION_NAME]
+    ongoing_batches = fetch_batches(client, TEST_DB_NAME, AML_ONGOING_MONITORING_COLLECTION_NAME, {"status": "todo"}, batch_size)
+    entries = finished = 0
+    while True:
+        with timer.stage("fetch_ongoing"):
+            try:
+                ongoing = await ongoing_batches.__anext__()
+            except StopAsyncIteration:
+                break
+        timer.add_items("fetch_ongoing", len(ongoing))
+        batch_entries = sum(len(item.get("data", [])) for item in ongoing)
+
+        with timer.stage("resolve_payloads", batch_entries):
+            unresolved_ongoing_ids = await resolve_ongoing_payloads(changelog_collection, ongoing, batch_size)
+            ongoing = [item for item in ongoing if item['_id'] not in unresolved_ongoing_ids]
+        with timer.stage("group", len(ongoing)):
+            grouped = group_ongoing_by_history(ongoing)
+        with timer.stage("fetch_history_results"):
+            history_results = await fetch(client, TEST_DB_NAME, HISTORY_RESULT_COLLECTION_NAME, {"aml_history_id": {"$in": list(grouped)}})
+            add_history_results_to_group(grouped, history_results)
+        timer.add_items("fetch_history_results", len(history_results))
+        with timer.stage("apply", batch_entries):
+            finished_ongoing_ids = await handle_group(history_result_collection, grouped, batch_size)
+        with timer.stage("status_update", len(finished_ongoing_ids)):
+            await ongoing_collection.update_many({"_id": {"$in": finished_ongoing_ids}}, {"$set": {"status": "done"}})
+
+        entries += batch_entries
+        finished += len(finished_ongoing_ids)
+
+    return {"ongoing_entries": entries, "ongoing_records_done": finished}
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    timer = StageTimer()
+    with timer.stage("generate"):
+        dataset = generate_dataset(args.seed, args.histories, args.changelogs, args.results_per_history, args.match_rate, args.body_size)
+
+    client = InMemoryClient()
+    with timer.stage("load"):
+        await client[TEST_DB_NAME][HISTORY_COLLECTION_NAME].insert_many(dataset["histories"])
+        await client[TEST_DB_NAME][HISTORY_RESULT_COLLECTION_NAME].insert_many(dataset["history_results"])
+        await client[SOURCE_DB_NAME][SOURCEDATA_CHANGELOGS_COLLECTION_NAME].insert_many(dataset["changelogs"])
+    del dataset
+
+    started_at = time.perf_counter()
+    matching = await run_matching(client, timer, args.batch_size, args.match_workers, args.watchlist_snapshot, args.reference_payloads)
+    matching_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    grouping = await run_grouping(client, timer, args.batch_size)
+    grouping_seconds = time.perf_counter() - started_at
+
+    return {
+        "parameters": vars(args),
+        "matching": {**matching, "seconds": matching_seconds, "changelogs_per_second": matching["changelogs_scanned"] / matching_seconds if matching_seconds else 0},
+        "grouping": {**grouping, "seconds": grouping_seconds, "entries_per_second": grouping["ongoing_entries"] / grouping_seconds if grouping_seconds else 0},
+        "stages": timer.stages,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+def print_report(report: dict):
+    matching = report["matching"]
+    grouping = report["grouping"]
+    print(f"Matching: {matching['changelogs_scanned']} changelogs, {matching['history_changelog_matches']} matches, {matching['ongoing_records']} ongoing records in {matching['seconds']:.3f}s ({matching['changelogs_per_second']:.0f} changelogs/s)")
+    print(f"Grouping: {grouping['ongoing_entries']} entries, {grouping['ongoing_records_done']} ongoing records done in {grouping['seconds']:.3f}s ({grouping['entries_per_second']:.0f} entries/s)")
+    print(f"{'stage':<24}{'seconds':>10}{'calls':>8}{'items':>10}{'items/s':>12}{'peak MB':>10}")
+    for name, stage in report["stages"].items():
+        rate = stage["items"] / stage["seconds"] if stage["seconds"] and stage["items"] else 0
+        print(f"{name:<24}{stage['seconds']:>10.3f}{stage['calls']:>8}{stage['items']:>10}{rate:>12.0f}{stage['peak_rss_mb']:>10.1f}")
+    print(f"Peak RSS: {report['peak_rss_mb']:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ongoing monitoring pipeline on synthetic data")
+    parser.add_argument("--histories", type=int, default=1000, help="Number of AML history records")
+    parser.add_argument("--changelogs", type=int, default=10000, help="Number of pending changelogs")
+    parser.add_argument("--results-per-history", type=int, default=5, help="Average number of existing history results per history")
+    parser.add_argument("--match-rate", type=float, default=0.05, help="Share of ADD changelogs naming a monitored subject")
+    parser.add_argument("--body-size", type=int, default=500, help="Approximate article body length in characters")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Changelog and ongoing batch size")
+    parser.add_argument("--match-workers", type=int, default=1, help="Process pool size for matching, 1 matches in process")
+    parser.add_argument("--watchlist-snapshot", help="Load the watchlist through a snapshot file at this path, built on the first run")
+    parser.add_argument("--reference-payloads", action="store_true", help="Store changelog references in the ongoing records and resolve the payloads when grouping")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this path")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import random
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+# Seeded generator of AML histories, history results and sourcedata changelogs
+# shaped like the production collections.
+
+EN_SURNAMES = ["Chan", "Wong", "Lee", "Cheung", "Lau", "Ng", "Ho", "Leung", "Lam", "Tsang", "Chow", "Yeung", "Kwok", "Mak", "Tang", "Fung", "Smith", "Brown", "Taylor", "Wilson", "Patel", "Khan"]
+EN_SYLLABLES = ["Tai", "Man", "Siu", "Ming", "Ka", "Wai", "Wing", "Kin", "Mei", "Ling", "Chi", "Keung", "Yuk", "Lan", "Kwok", "Wah", "Hoi", "Yan", "Tsz", "Hin", "Pui", "Shan", "Chun", "Kit", "Sze", "Nga", "Lok", "Fai", "Hung", "Yee"]
+EN_FIRST_NAMES = ["John", "Mary", "David", "Peter", "Susan", "Michael", "Alice", "Raymond", "Vincent", "Karen", "Winnie", "Gordon"]
+EN_COMPANY_WORDS = ["Pacific", "Golden", "Dragon", "Harbour", "Orient", "Summit", "Union", "Evergreen", "Victory", "Fortune", "Crystal", "Phoenix"]
+EN_COMPANY_SUFFIXES = ["Holdings Limited", "Trading Co", "International Ltd", "Group", "Investment Limited", "Technology Ltd"]
+ZH_SURNAMES = "陳黃李張劉吳何梁林曾周楊郭麥鄧馮"
+ZH_GIVEN_CHARACTERS = "大文小明家偉永健美玲志強玉蘭國華海欣子軒佩珊俊傑詩雅樂輝雄儀思敏嘉豪"
+ZH_COMPANY_WORDS = ["太平洋", "金", "龍", "海港", "東方", "高峰", "聯合", "長青", "勝利", "富", "水晶", "鳳凰"]
+ZH_COMPANY_SUFFIXES = ["控股有限公司", "貿易公司", "國際有限公司", "集團", "投資有限公司"]
+WORDS = ["court", "fraud", "investigation", "company", "director", "bank", "regulator", "charged", "alleged", "market", "shares", "fund", "police", "report"]
+
+def generate_id(rng: random.Random) -> ObjectId:
+    return ObjectId(rng.randbytes(12))
+
+def generate_subject(rng: random.Random) -> tuple[str, str]:
+    if rng.random() < 0.3:
+        name_en = f"{rng.choice(EN_COMPANY_WORDS)} {rng.choice(EN_SURNAMES)} {rng.choice(EN_COMPANY_SUFFIXES)}"
+        name_zh = f"{rng.choice(ZH_COMPANY_WORDS)}{rng.choice(ZH_SURNAMES)}{rng.choice(ZH_GIVEN_CHARACTERS)}{rng.choice(ZH_COMPANY_SUFFIXES)}"
+    else:
+        if rng.random() < 0.2:
+            given_name = rng.choice(EN_FIRST_NAMES)
+        else:
+            given_name = f"{rng.choice(EN_SYLLABLES)} {rng.choice(EN_SYLLABLES)}"
+        name_en = f"{rng.choice(EN_SURNAMES)} {given_name}"
+        name_zh = rng.choice(ZH_SURNAMES) + "".join(rng.choice(ZH_GIVEN_CHARACTERS) for _ in range(2))
+    return name_en, name_zh
+
+def generate_text(rng: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def generate_histories(rng: random.Random, count: int, now: datetime) -> list[dict]:
+    histories = []
+    for _ in range(count):
+        name_en, name_zh = generate_subject(rng)
+        histories.append({
+            "_id": generate_id(rng),
+            "nameEN": name_en,
+            "nameZH": name_zh if rng.random() < 0.8 else "",
+            "searchBy": rng.choice(["name", "company"]),
+            "ongoing_monitoring": rng.random() < 0.9,
+            "createdAt": now - timedelta(days=rng.randint(1, 365)),
+            "updatedAt": now - timedelta(days=rng.randint(0, 30)),
+        })
+    return histories
+
+def generate_article(rng: random.Random, article_id: ObjectId, names: list[tuple[str, str]], body_size: int, target_shape: str) -> dict:
+    if target_shape == "list":
+        target = [{"name_en": name_en, "name_zh": name_zh} for name_en, name_zh in names]
+    else:
+        target = {
+            "en": [{"ceName": name_en} for name_en, _ in names],
+            "zh": [{"ceName": name_zh} for _, name_zh in names],
+        }
+    headline = generate_text(rng, 60)
+    return {
+        "_id": article_id,
+        "target": target,
+        "headline": {"en": headline, "zh": headline},
+        "content": {"en": generate_text(rng, body_size), "zh": generate_text(rng, body_size // 2)},
+        "urls": [f"https://news.example.com/{article_id}"],
+        "source": {"title": rng.choice(["Daily News", "Finance Post", "Court Weekly"])},
+        "published": (datetime(2024, 1, 1) + timedelta(days=rng.randint(0, 600))).strftime("%Y-%m-%d"),
+    }
+
+def generate_judgment(rng: random.Random, judgment_id: ObjectId, names: list[tuple[str, str]]) -> dict:
+    parties = [name_en if rng.random() < 0.8 else name_zh for name_en, name_zh in names]
+    return {
+        "_id": judgment_id,
+        "title": " v ".join(parties) if len(parties) > 1 else f"HKSAR v {parties[0]}",
+        "court": rng.choice(["CFI", "DC", "CA"]),
+        "date": (datetime(2024, 1, 1) + timedelta(days=rng.randint(0, 600))).strftime("%Y-%m-%d"),
+    }
+
+def generate_dataset(
+    seed: int = 42,
+    history_count: int = 1000,
+    changelog_count: int = 10000,
+    results_per_history: int = 5,
+    match_rate: float = 0.05,
+    body_size: int = 500
+) -> dict:
+    """
+    Generate histories, their existing history results and pending changelogs.
+
+    match_rate is the share of changelog targets taken from the watchlist. MOD and DEL
+    changelogs refer to articles that already have a history result, the way re-published
+    or retracted stories do.
+    """
+    rng = random.Random(seed)
+    now = datetime(2025, 1, 1)
+    histories = generate_histories(rng, history_count, now)
+    monitored = [history for history in histories if history["ongoing_monitoring"]] or histories
+
+    history_results = []
+    for history in monitored:
+        for _ in range(rng.randint(0, results_per_history * 2)):
+            category = "adverse media" if rng.random() < 0.6 else "judgment"
+            history_results.append({
+                "_id": generate_id(rng),
+                "aml_history_id": history["_id"],
+                "type": "News" if category == "adverse media" else "Judgment",
+                "category": "AdverseMedia" if category == "adverse media" else "Judgment",
+                "data_id": str(generate_id(rng)),
+                "result": {"title": generate_text(rng, 40)},
+                "createdAt": now - timedelta(days=rng.randint(1, 300)),
+                "updatedAt": now - timedelta(days=rng.randint(0, 30)),
+            })
+    history_by_id = {history["_id"]: history for history in histories}
+
+    changelogs = []
+    for _ in range(changelog_count):
+        action = rng.choices(["ADD", "MOD", "DEL"], weights=[0.6, 0.35, 0.05])[0]
+        names = [generate_subject(rng) for _ in range(rng.randint(1, 3))]
+        if action != "ADD" and history_results:
+            # Update or retract an article that already matched a monitored subject
+            history_result = rng.choice(history_results)
+            history = history_by_id[history_result["aml_history_id"]]
+            data_id = ObjectId(history_result["data_id"])
+            category = "adverse media" if history_result["category"] == "AdverseMedia" else "judgment"
+            names[0] = (history["nameEN"], history["nameZH"])
+        else:
+            action = "ADD"
+            data_id = generate_id(rng)
+            category = "adverse media" if rng.random() < 0.6 else "judgment"
+            if rng.random() < match_rate:
+                history = rng.choice(monitored)
+                names[0] = (history["nameEN"], history["nameZH"])
+        rng.shuffle(names)
+
+        if category == "adverse media":
+            new_data = generate_article(rng, data_id, names, body_size, rng.choice(["list", "dict"]))
+        else:
+            new_data = generate_judgment(rng, data_id, names)
+        changelog = {
+            "_id": generate_id(rng),
+            "original_data_id": str(data_id),
+            "category": category,
+            "action": action,
+            "status": "pending",
+            "new_data": new_data,
+            "old_data": new_data if action == "DEL" else (dict(new_data, headline={"en": "", "zh": ""}) if action == "MOD" else None),
+            "createdAt": now + timedelta(seconds=len(changelogs)),
+        }
+        if action == "MOD":
+            changelog["changes"] = [{"field": "headline.en", "old_value": "", "new_value": new_data.get("headline", {}).get("en", new_data.get("title"))}]
+        changelogs.append(changelog)
+
+    return {
+        "histories": histories,
+        "history_results": history_results,
+        "changelogs": changelogs,
+    }
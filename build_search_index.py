@@ -0,0 +1,38 @@
+from dotenv import load_dotenv
+import os
+from pymongo import AsyncMongoClient
+import asyncio
+import argparse
+import logging
+from utilities.search_index import ensure_search_index, backfill_search_ngrams, get_media_names, get_judgment_names
+from utilities.log import configure_logging
+
+logger = logging.getLogger(__name__)
+
+async def main(rebuild: bool = False):
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING)
+    
+    source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
+    media_collection_name = str(os.getenv("MEDIA_COLLECTION_NAME"))
+    judgment_collection_name = str(os.getenv("JUDGMENT_COLLECTION_NAME"))
+    
+    media_collection = client[source_db_name][media_collection_name]
+    judgment_collection = client[source_db_name][judgment_collection_name]
+    
+    # Backfill search n-grams, then index them
+    for collection, get_names in [(media_collection, get_media_names), (judgment_collection, get_judgment_names)]:
+        modified = await backfill_search_ngrams(collection, get_names, rebuild)
+        await ensure_search_index(collection)
+        logger.info("Updated search n-grams of %d documents in %s", modified, collection.name)
+    
+    # Close connection
+    await client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill and index the search n-grams of the media and judgment collections")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute n-grams for every document, not only the missing ones")
+    args = parser.parse_args()
+    asyncio.run(main(args.rebuild))
@@ -0,0 +1,186 @@
+from dotenv import load_dotenv
+import os
+import argparse
+import asyncio
+import gzip
+import itertools
+import logging
+import time
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import AsyncMongoClient, IndexModel
+from utilities.log import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# A snapshot is a directory with one gzip-compressed stream of BSON documents per collection
+# and a manifest of the collections, their document counts and indexes. Documents are kept
+# as raw BSON on both sides, so they are never decoded into Python objects.
+MANIFEST_NAME = "manifest.json"
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+# Snapshots are written once per fixture and restored on every run, favour speed over size
+COMPRESS_LEVEL = 1
+# A collection is restored into <name><suffix>, then renamed over the collection once complete
+RESTORE_STAGING_SUFFIX = ".restoring"
+
+def get_default_namespaces() -> list[str]:
+    """
+    The collections the monitoring jobs read and write, as database.collection
+    """
+    source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
+    test_db_name = str(os.getenv("TEST_DATABASE_NAME"))
+    return [
+        f"{source_db_name}.{os.getenv('SOURCEDATA_CHANGELOGS_COLLECTION_NAME')}",
+        f"{source_db_name}.{os.getenv('MEDIA_COLLECTION_NAME')}",
+        f"{source_db_name}.{os.getenv('JUDGMENT_COLLECTION_NAME')}",
+        f"{test_db_name}.{os.getenv('HISTORY_COLLECTION_NAME')}",
+        f"{test_db_name}.{os.getenv('HISTORY_RESULT_COLLECTION_NAME')}",
+        f"{test_db_name}.{os.getenv('AML_ONGOING_MONITORING_COLLECTION_NAME')}",
+        f"{test_db_name}.{os.getenv('CHECKPOINT_COLLECTION_NAME', 'aml_ongoing_monitoring_checkpoints')}",
+        f"{test_db_name}.{os.getenv('RESUME_TOKEN_COLLECTION_NAME', 'aml_ongoing_monitoring_resume_tokens')}",
+    ]
+
+def read_batch(documents, batch_size: int) -> list:
+    return list(itertools.islice(documents, batch_size))
+
+async def save_collection(client: AsyncMongoClient, namespace: str, path: str, batch_size: int = 1000) -> dict:
+    database_name, collection_name = namespace.split(".", 1)
+    collection = client[database_name].get_collection(collection_name, codec_options=RAW_CODEC_OPTIONS)
+    indexes = {name: index for name, index in (await client[database_name][collection_name].index_information()).items() if name != "_id_"}
+
+    file_name = f"{namespace}.bson.gz"
+    count = 0
+    with gzip.open(os.path.join(path, file_name), "wb", compresslevel=COMPRESS_LEVEL) as f:
+        batch = []
+        async for document in collection.find({}, batch_size=batch_size):
+            batch.append(document.raw)
+            if len(batch) >= batch_size:
+                await asyncio.to_thread(f.write, b"".join(batch))
+                count += len(batch)
+                batch = []
+        await asyncio.to_thread(f.write, b"".join(batch))
+        count += len(batch)
+
+    logger.info("Saved %d documents of %s", count, namespace)
+    return {"namespace": namespace, "file": file_name, "count": count, "indexes": indexes}
+
+async def save_snapshot(client: AsyncMongoClient, path: str, namespaces: list[str], batch_size: int = 1000, parallelism: int = 4) -> dict:
+    """
+    Dump the collections to path. The manifest is written last, a snapshot without one is incomplete.
+    """
+    os.makedirs(path, exist_ok=True)
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def save(namespace: str) -> dict:
+        async with semaphore:
+            return await save_collection(client, namespace, path, batch_size)
+
+    manifest = {"collections": await asyncio.gather(*[save(namespace) for namespace in namespaces])}
+    with open(os.path.join(path, MANIFEST_NAME), "w") as f:
+        f.write(json_util.dumps(manifest, indent=2))
+    return manifest
+
+def read_manifest(path: str) -> dict:
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json_util.loads(f.read())
+
+async def restore_collection(client: AsyncMongoClient, entry: dict, path: str, database_name: str|None = None, batch_size: int = 1000, semaphore: asyncio.Semaphore|None = None) -> int:
+    """
+    Replace a collection with its snapshot, sending up to the semaphore's value of insert_many
+    batches at once. Indexes are built once the documents are in. The collection is left as it
+    was when the snapshot file cannot be read or the restore fails.
+    """
+    source_database_name, collection_name = entry["namespace"].split(".", 1)
+    database = client[database_name or source_database_name]
+    collection = database.get_collection(collection_name, codec_options=RAW_CODEC_OPTIONS)
+    staging_name = f"{collection_name}{RESTORE_STAGING_SUFFIX}"
+    semaphore = semaphore or asyncio.Semaphore(1)
+    # Dropped first in case an interrupted restore left it, created so that empty collections are renamed too
+    await database.drop_collection(staging_name)
+    staging = await database.create_collection(staging_name, codec_options=RAW_CODEC_OPTIONS)
+
+    async def insert(batch: list):
+        try:
+            await staging.insert_many(batch, ordered=False, bypass_document_validation=True)
+        finally:
+            semaphore.release()
+
+    inserts = []
+    try:
+        with gzip.open(os.path.join(path, entry["file"]), "rb") as f:
+            documents = bson.decode_file_iter(f, RAW_CODEC_OPTIONS)
+            while batch := await asyncio.to_thread(read_batch, documents, batch_size):
+                await semaphore.acquire()
+                inserts.append(asyncio.create_task(insert(batch)))
+            await asyncio.gather(*inserts)
+
+        indexes = []
+        for name, index in entry["indexes"].items():
+            options = {key: value for key, value in index.items() if key not in ("key", "v", "ns")}
+            indexes.append(IndexModel([tuple(key) for key in index["key"]], name=name, **options))
+        if indexes:
+            await staging.create_indexes(indexes)
+
+        count = await staging.estimated_document_count()
+        if count != entry["count"]:
+            raise RuntimeError(f"Restored {count} documents into {staging.full_name}, the snapshot has {entry['count']}")
+        await staging.rename(collection_name, dropTarget=True)
+    except Exception:
+        await asyncio.gather(*inserts, return_exceptions=True)
+        await staging.drop()
+        raise
+    logger.info("Restored %d documents into %s", count, collection.full_name)
+    return count
+
+async def restore_snapshot(client: AsyncMongoClient, path: str, database_name: str|None = None, batch_size: int = 1000, parallelism: int = 4) -> int:
+    """
+    Restore every collection of the snapshot at path, into database_name when given
+    instead of the databases they were saved from.
+    """
+    manifest = read_manifest(path)
+    missing = [entry["file"] for entry in manifest["collections"] if not os.path.isfile(os.path.join(path, entry["file"]))]
+    if missing:
+        raise FileNotFoundError(f"Snapshot {path} is missing {', '.join(missing)}, no collection was restored")
+    if database_name:
+        collection_names = [entry["namespace"].split(".", 1)[1] for entry in manifest["collections"]]
+        if len(set(collection_names)) < len(collection_names):
+            raise ValueError(f"Snapshot {path} has collections with the same name in different databases, restore them separately")
+    semaphore = asyncio.Semaphore(parallelism)
+    counts = await asyncio.gather(*[
+        restore_collection(client, entry, path, database_name, batch_size, semaphore)
+        for entry in manifest["collections"]
+    ])
+    return sum(counts)
+
+async def main(args: argparse.Namespace):
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING)
+    started_at = time.perf_counter()
+    try:
+        if args.command == "save":
+            manifest = await save_snapshot(client, args.path, args.collections or get_default_namespaces(), args.batch_size, args.parallelism)
+            logger.info("Saved %d collections to %s in %.1fs", len(manifest["collections"]), args.path, time.perf_counter() - started_at)
+        else:
+            count = await restore_snapshot(client, args.path, args.database, args.batch_size, args.parallelism)
+            logger.info("Restored %d documents from %s in %.1fs", count, args.path, time.perf_counter() - started_at)
+    finally:
+        # Close connection
+        await client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save the monitoring collections to a snapshot directory, or restore them from one")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    save_parser = subparsers.add_parser("save", help="Dump collections to compressed BSON files")
+    save_parser.add_argument("path", help="Snapshot directory")
+    save_parser.add_argument("--collections", nargs="+", help="database.collection names, the monitoring collections by default")
+    restore_parser = subparsers.add_parser("restore", help="Replace collections with a snapshot")
+    restore_parser.add_argument("path", help="Snapshot directory")
+    restore_parser.add_argument("--database", help="Restore every collection into this scratch database")
+    for subparser in (save_parser, restore_parser):
+        subparser.add_argument("--batch-size", type=int, default=1000, help="Documents per read or insert batch")
+        subparser.add_argument("--parallelism", type=int, default=4, help="Collections saved, or insert batches sent, at once")
+    asyncio.run(main(parser.parse_args()))
@@ -1,32 +1,92 @@
 from dotenv import load_dotenv
 import os
-from pymongo import AsyncMongoClient
+from pymongo import AsyncMongoClient, InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 import asyncio
-from utilities.fetch import fetch
+import time
+from bson import ObjectId
+from utilities.fetch import fetch_batches
 from datetime import datetime
+import logging
+from utilities.log import configure_logging
+from utilities.metrics import get_metrics, recorded_run, time_iterator
 
-async def find_history_result_by_data_id(history_results: list[dict], data_id: str|None):
-    if not data_id:
-        return None
-    
+logger = logging.getLogger(__name__)
+
+# The changelog payload fields handle_group builds history results from
+ONGOING_PAYLOAD_PROJECTION = {"new_data.headline.en": 1, "new_data.urls": 1, "new_data.content.en": 1}
+
+def index_history_results_by_data_id(history_results: list[dict]) -> dict:
+    history_result_index = {}
     for history_result in history_results:
-        if history_result.get("data_id") == data_id:
-            return history_result
-    return None
+        data_id = history_result.get("data_id")
+        if data_id:
+            # Keep the first result per data_id, like the previous linear scan
+            history_result_index.setdefault(data_id, history_result)
+    return history_result_index
+
+async def write_history_result_operations(collection, operations: list[dict], batch_size: int = 1000, session=None) -> set:
+    """
+    Send history_result operations with bulk_write in batches of batch_size.
+    A batch is only ordered when it touches the same document more than once.
+    Returns the ids of the ongoing records with at least one operation that was not applied.
+    Within a transaction errors are raised instead, the server has already aborted it.
+    """
+    failed_ongoing_ids = set()
+    metrics = get_metrics()
+    for start in range(0, len(operations), batch_size):
+        batch = operations[start:start + batch_size]
+        requests = [operation["request"] for operation in batch]
+        ordered = len({operation["target_id"] for operation in batch}) < len(batch)
+        batch_number = start // batch_size + 1
+        try:
+            with metrics.timer("history_result_write"):
+                result = await collection.bulk_write(requests, ordered=ordered, session=session)
+            metrics.inc("history_results_inserted", result.inserted_count)
+            metrics.inc("history_results_modified", result.modified_count)
+            metrics.inc("history_results_deleted", result.deleted_count)
+            logger.info("History result batch %d: inserted %d, modified %d, deleted %d", batch_number, result.inserted_count, result.modified_count, result.deleted_count)
+        except BulkWriteError as error:
+            write_errors = error.details.get("writeErrors", [])
+            failed_indexes = {write_error["index"] for write_error in write_errors}
+            if ordered and failed_indexes:
+                # Ordered bulk writes stop at the first error
+                failed_indexes = set(range(min(failed_indexes), len(batch)))
+            metrics.inc("errors", len(write_errors))
+            logger.error("History result batch %d: %d write errors, %d operations not applied: %s", batch_number, len(write_errors), len(failed_indexes), write_errors[:5])
+            if session is not None:
+                raise
+            for index in failed_indexes:
+                failed_ongoing_ids.update(batch[index]["ongoing_ids"])
+        except Exception as error:
+            metrics.inc("errors")
+            logger.error("History result batch %d failed: %s", batch_number, error)
+            if session is not None:
+                raise
+            for operation in batch:
+                failed_ongoing_ids.update(operation["ongoing_ids"])
+    return failed_ongoing_ids
 
-async def handle_group(collection, group: dict):
-    history_result_tasks = []
+async def handle_group(collection, group: dict, batch_size: int = 1000, session=None, applied_ongoing_ids: set|None = None):
+    # The time to build the operations is recorded as apply, sending them as history_result_write
+    apply_started_at = time.perf_counter()
+    operations = []
     finished_ongoing_ids = []
     for history_id, data in group.items():
         ongoings = data.get("ongoing")
-        history_results = data.get("history_result")
-        if ongoings and history_results:
+        # A history without results yet still gets the results its ADD changelogs create
+        history_results = data.get("history_result") or []
+        if ongoings:
             changelog_data = []
             for ongoing in ongoings:
-                changelog_data.extend(ongoing.get("data", []))
+                changelog_data.extend((ongoing.get("_id"), changelog) for changelog in ongoing.get("data", []))
             
-            for changelog in changelog_data:
-                history_result = await find_history_result_by_data_id(history_results, changelog.get("data_id"))
+            # Results inserted in this run are indexed too, so later changelogs of the same data_id see them
+            history_result_index = index_history_results_by_data_id(history_results)
+            pending_inserts = {}
+            for ongoing_id, changelog in changelog_data:
+                data_id = changelog.get("data_id")
+                history_result = history_result_index.get(data_id) if data_id else None
                 if history_result:
                     if changelog.get("type") == "MOD":
                                                 
@@ -37,13 +97,37 @@ async def handle_group(collection, group: dict):
                             "description": changelog.get("new_data", {}).get("content", {}).get("en", ""),
                         }
 
-                        history_result_tasks.append(collection.update_one(
-                            {"_id": history_result.get("_id")},
-                            {"$set": {
-                                "result": formatted_new_data,
-                                "updatedAt": datetime.now()
-                            }}
-                        ))
+                        if history_result.get("_id") in pending_inserts:
+                            # Not written yet, fold the change into the pending insert
+                            history_result["result"] = formatted_new_data
+                            history_result["updatedAt"] = datetime.now()
+                            pending_inserts[history_result.get("_id")]["ongoing_ids"].add(ongoing_id)
+                            continue
+
+                        operations.append({
+                            "request": UpdateOne(
+                                {"_id": history_result.get("_id")},
+                                {"$set": {
+                                    "result": formatted_new_data,
+                                    "updatedAt": datetime.now()
+                                }}
+                            ),
+                            "target_id": history_result.get("_id"),
+                            "ongoing_ids": {ongoing_id}
+                        })
+                    elif changelog.get("type") == "DEL":
+                        del history_result_index[data_id]
+                        pending_insert = pending_inserts.pop(history_result.get("_id"), None)
+                        if pending_insert:
+                            # Inserted and deleted in the same run, skip both
+                            operations.remove(pending_insert)
+                            continue
+
+                        operations.append({
+                            "request": DeleteOne({"_id": history_result.get("_id")}),
+                            "target_id": history_result.get("_id"),
+                            "ongoing_ids": {ongoing_id}
+                        })
                 else:
                     if changelog.get("type") == "ADD":
                         # New format
@@ -68,40 +152,43 @@ async def handle_group(collection, group: dict):
                             "description": changelog.get("new_data", {}).get("content", {}).get("en", ""),
                         }
 
-                        history_result_tasks.append(collection.insert_one(
-                            {
-                                "aml_history_id": history_id,
-                                "type": type_mapping.get(changelog.get("category")),
-                                "category": category_mapping.get(changelog.get("category")),
-                                "data_id": str(changelog.get("data_id")) if changelog.get("data_id") else None,
-                                "result": formatted_new_data,
-                                "createdAt": datetime.now(),
-                                "updatedAt": datetime.now()
-                            }
-                        ))
+                        new_history_result = {
+                            "_id": ObjectId(),
+                            "aml_history_id": history_id,
+                            "type": type_mapping.get(changelog.get("category")),
+                            "category": category_mapping.get(changelog.get("category")),
+                            "data_id": str(changelog.get("data_id")) if changelog.get("data_id") else None,
+                            "result": formatted_new_data,
+                            "createdAt": datetime.now(),
+                            "updatedAt": datetime.now()
+                        }
+                        operation = {
+                            "request": InsertOne(new_history_result),
+                            "target_id": new_history_result["_id"],
+                            "ongoing_ids": {ongoing_id}
+                        }
+                        if data_id:
+                            history_result_index[data_id] = new_history_result
+                            pending_inserts[new_history_result["_id"]] = operation
+
+                        operations.append(operation)
         
         finished_ongoing_ids.extend([ongoing.get("_id") for ongoing in ongoings])
+    metrics = get_metrics()
+    metrics.add_time("apply", time.perf_counter() - apply_started_at)
+    metrics.inc("history_result_operations", len(operations))
     
-    await asyncio.gather(*history_result_tasks)
-    return finished_ongoing_ids
+    failed_ongoing_ids = await write_history_result_operations(collection, operations, batch_size, session)
+    if applied_ongoing_ids is not None:
+        # The records that changed history_result, the others had nothing to apply
+        applied_ongoing_ids.update(
+            ongoing_id for operation in operations for ongoing_id in operation["ongoing_ids"] if ongoing_id not in failed_ongoing_ids
+        )
+    # Ongoing records with unapplied changes stay todo and are retried on the next run
+    return [ongoing_id for ongoing_id in finished_ongoing_ids if ongoing_id not in failed_ongoing_ids]
 
-async def main():
-    load_dotenv()
-    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
-    client = AsyncMongoClient(CONNECTION_STRING)
-    
-    # source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
-    # media_collection_name = str(os.getenv("MEDIA_COLLECTION_NAME"))
-    # judgment_collection_name = str(os.getenv("JUDGMENT_COLLECTION_NAME"))
-    # sourcedata_changelogs_collection_name = str(os.getenv("SOURCEDATA_CHANGELOGS_COLLECTION_NAME"))
-    
-    test_db_name = str(os.getenv("TEST_DATABASE_NAME"))
-    history_collection_name = str(os.getenv("HISTORY_COLLECTION_NAME"))
-    history_result_collection_name = str(os.getenv("HISTORY_RESULT_COLLECTION_NAME"))
-    aml_ongoing_monitoring_collection_name = str(os.getenv("AML_ONGOING_MONITORING_COLLECTION_NAME"))
-    
-    # Fetch ongoing records and sort data by createdAt
-    ongoing = await fetch(client, test_db_name, aml_ongoing_monitoring_collection_name, {"status": "todo"})
+def group_ongoing_by_history(ongoing: list[dict]) -> dict:
+    # Sort data by createdAt
     for item in ongoing:
         if isinstance(item.get("data"), list):
             data_list = item.get("data")
@@ -118,12 +205,9 @@ async def main():
                 "history_result": []
             }
         grouped[history_id]["ongoing"].append(item)
+    return grouped
 
-    # Blob object id
-    history_id = [item['aml_history_id'] for item in ongoing]
-    
-    # Fetch history results
-    history_results = await fetch(client, test_db_name, history_result_collection_name, {"aml_history_id": {"$in": history_id}})
+def add_history_results_to_group(grouped: dict, history_results: list[dict]) -> dict:
     for result in history_results: 
         history_id = result['aml_history_id']
         if history_id not in grouped:
@@ -132,17 +216,107 @@ async def main():
                 "history_result": []
             }
         grouped[history_id]["history_result"].append(result)
-        
-    finished_ongoing_ids = await handle_group(client[test_db_name][history_result_collection_name], grouped)
-    await client[test_db_name][aml_ongoing_monitoring_collection_name].update_many(
-        {"_id": {"$in": finished_ongoing_ids}},
-        {
-            "$set": {
-                "status": "done",
-                "updatedAt": datetime.now()
+    return grouped
+
+async def resolve_ongoing_payloads(changelog_collection, ongoing: list[dict], batch_size: int = 1000, session=None) -> set:
+    """
+    Load the new_data of the ADD and MOD entries stored by reference, once per distinct changelog.
+    Returns the ids of the ongoing records with an entry whose changelog no longer exists.
+    """
+    references = {}
+    for item in ongoing:
+        for entry in item.get("data", []):
+            if entry.get("type") in ("ADD", "MOD") and "new_data" not in entry:
+                references.setdefault(entry.get("sourcedata_changelogs_id"), []).append((item.get("_id"), entry))
+
+    changelog_ids = list(references)
+    for start in range(0, len(changelog_ids), batch_size):
+        changelogs = await changelog_collection.find({"_id": {"$in": changelog_ids[start:start + batch_size]}}, ONGOING_PAYLOAD_PROJECTION, session=session).to_list()
+        for changelog in changelogs:
+            for _, entry in references.pop(changelog["_id"]):
+                entry["new_data"] = changelog.get("new_data") or {}
+
+    unresolved_ongoing_ids = {ongoing_id for entries in references.values() for ongoing_id, _ in entries}
+    if references:
+        logger.error("%d referenced changelogs not found, %d ongoing records left todo: %s", len(references), len(unresolved_ongoing_ids), list(references)[:5])
+    return unresolved_ongoing_ids
+
+async def apply_ongoing_to_history_results(collection, ongoing: list[dict], batch_size: int = 1000, session=None, changelog_collection=None, applied_ongoing_ids: set|None = None) -> list:
+    """
+    Apply ongoing records to history_result and return the ids of the records fully applied.
+    Payloads stored by reference are read from changelog_collection. The ids of the records
+    that changed history_result are added to applied_ongoing_ids when given.
+    """
+    metrics = get_metrics()
+    if changelog_collection is not None:
+        with metrics.timer("resolve_payloads"):
+            unresolved_ongoing_ids = await resolve_ongoing_payloads(changelog_collection, ongoing, batch_size, session)
+        ongoing = [item for item in ongoing if item.get("_id") not in unresolved_ongoing_ids]
+
+    with metrics.timer("group"):
+        grouped = group_ongoing_by_history(ongoing)
+
+    # Blob object id
+    history_id = [item['aml_history_id'] for item in ongoing]
+
+    # Fetch history results
+    with metrics.timer("fetch_history_results"):
+        history_results = await collection.find({"aml_history_id": {"$in": history_id}}, session=session).to_list()
+    with metrics.timer("group"):
+        add_history_results_to_group(grouped, history_results)
+    
+    return await handle_group(collection, grouped, batch_size, session, applied_ongoing_ids)
+
+async def process_ongoing_batch(client: AsyncMongoClient, test_db_name: str, history_result_collection_name: str, aml_ongoing_monitoring_collection_name: str, ongoing: list[dict], history_result_batch_size: int = 1000, changelog_collection=None) -> list:
+    finished_ongoing_ids = await apply_ongoing_to_history_results(client[test_db_name][history_result_collection_name], ongoing, history_result_batch_size, changelog_collection=changelog_collection)
+    metrics = get_metrics()
+    with metrics.timer("status_update"):
+        await client[test_db_name][aml_ongoing_monitoring_collection_name].update_many(
+            {"_id": {"$in": finished_ongoing_ids}},
+            {
+                "$set": {
+                    "status": "done",
+                    "updatedAt": datetime.now()
+                }
             }
-        }
-    )
+        )
+    metrics.inc("ongoing_records_read", len(ongoing))
+    metrics.inc("ongoing_records_done", len(finished_ongoing_ids))
+    return finished_ongoing_ids
+
+@recorded_run("update_history_result")
+async def run_update_history_result(client: AsyncMongoClient):
+    """
+    Apply the todo ongoing records to history_result once, with the given client
+    """
+    source_db_name = str(os.getenv("SOURCE_DATABASE_NAME"))
+    # media_collection_name = str(os.getenv("MEDIA_COLLECTION_NAME"))
+    # judgment_collection_name = str(os.getenv("JUDGMENT_COLLECTION_NAME"))
+    sourcedata_changelogs_collection_name = str(os.getenv("SOURCEDATA_CHANGELOGS_COLLECTION_NAME"))
+    
+    test_db_name = str(os.getenv("TEST_DATABASE_NAME"))
+    history_collection_name = str(os.getenv("HISTORY_COLLECTION_NAME"))
+    history_result_collection_name = str(os.getenv("HISTORY_RESULT_COLLECTION_NAME"))
+    aml_ongoing_monitoring_collection_name = str(os.getenv("AML_ONGOING_MONITORING_COLLECTION_NAME"))
+    
+    ongoing_batch_size = int(os.getenv("ONGOING_BATCH_SIZE", "1000"))
+    history_result_batch_size = int(os.getenv("HISTORY_RESULT_BATCH_SIZE", "1000"))
+    
+    # Fetch ongoing records batch by batch and apply them to history_result
+    async for ongoing in time_iterator(fetch_batches(client, test_db_name, aml_ongoing_monitoring_collection_name, {"status": "todo"}, ongoing_batch_size), "fetch"):
+        # Entries stored by reference get their payloads from the changelogs
+        await process_ongoing_batch(client, test_db_name, history_result_collection_name, aml_ongoing_monitoring_collection_name, ongoing, history_result_batch_size, client[source_db_name][sourcedata_changelogs_collection_name])
+
+async def main():
+    load_dotenv()
+    configure_logging()
+    CONNECTION_STRING = str(os.getenv("CONNECTION_STRING"))
+    client = AsyncMongoClient(CONNECTION_STRING)
+    try:
+        await run_update_history_result(client)
+    finally:
+        # Close connection
+        await client.close()
 
     
 if __name__ == "__main__":
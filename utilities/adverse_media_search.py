@@ -2,40 +2,81 @@ from pymongo import AsyncMongoClient
 from typing import List, Dict, Any
 import os
 import json
-from utilities.text_similarity import get_similarities
+import asyncio
+import logging
+import numpy as np
+from utilities.text_similarity import get_pairwise_similarities, get_cjk_bigrams, get_cjk_similarity_hits, is_cjk_character
+from utilities.search_index import SEARCH_NGRAMS_FIELD, get_search_pattern, get_any_search_ngram_condition, get_matched_patterns_expression, as_string_array
+from utilities.result_cache import get_screening_cache, get_screening_invalidation_collection, normalize_screening_name, sync_screening_cache
+from utilities.log import LazyJson, sample_debug
 
+logger = logging.getLogger(__name__)
 
-async def get_adverse_media(collection, name: str) -> List[Dict]:
-    
-    if not name:
-        return []
-    
-    # Preprocess search name
-    normalized_search_name = name.lower().strip()
-    print(f'Original search name: {name}')
-    print(f'Normalized search name: {normalized_search_name}')
+
+# Target name fields searched, as regex paths after the target array is unwound
+MEDIA_NAME_FIELDS = ["target.name_en", "target.name_zh", "target.en.ceName", "target.zh.ceName"]
+MATCHED_PATTERNS_FIELD = "matched_patterns"
+
+async def get_adverse_media_candidates_by_name(collection, names: List[str]) -> Dict[str, List[Dict]]:
+    """
+    Search several names in one aggregation. Every target is tagged with the names it
+    matches, then each tagged target is scored against its name in one pass.
+
+    Returns:
+        Matching articles by normalized search name, names that are not valid patterns are left out
+    """
+    results = {}
+    # Search pattern -> normalized search name
+    patterns = {}
+    search_bigrams = {}
+    for name in names:
+        # Preprocess search name
+        normalized_search_name = normalize_screening_name(name)
+        if not normalized_search_name or normalized_search_name in results:
+            continue
+        logger.debug('Normalized search name: %s -> %s', name, normalized_search_name)
+        pattern = get_search_pattern(normalized_search_name)
+        if pattern is None:
+            logger.error('Error searching for adverse media with name %s: invalid pattern', name)
+            continue
+        results[normalized_search_name] = []
+
+        # Chinese names are scored on character bigrams against the Chinese target names
+        if any(is_cjk_character(character) for character in normalized_search_name):
+            search_bigrams[normalized_search_name] = get_cjk_bigrams(normalized_search_name)
+            if search_bigrams[normalized_search_name] is None:
+                logger.debug('Skipping single character Chinese name: %s', name)
+                continue
+        patterns[pattern] = normalized_search_name
+
+    if not patterns:
+        return results
 
     # Get candidates with loose conditions
-    pipeline = [
+    pipeline = []
+    search_ngram_condition = get_any_search_ngram_condition(list(patterns.values()))
+    if search_ngram_condition:
+        # Narrow down with the indexed name n-grams before unwinding
+        pipeline.append({"$match": search_ngram_condition})
+    target_name_texts = {"$concatArrays": [as_string_array(f"${field}") for field in MEDIA_NAME_FIELDS]}
+    combined_pattern = "|".join(f"(?:{pattern})" for pattern in patterns)
+    pipeline += [
         # Unwind target array
         {"$unwind": {"path": "$target", "preserveNullAndEmptyArrays": True}},
         
         # Match conditions
-        {
-            "$match": {
-                "$or": [
-                    {"target.name_en": {"$regex": f".*{normalized_search_name}.*", "$options": "i"}},
-                    {"target.name_zh": {"$regex": f".*{normalized_search_name}.*", "$options": "i"}},
-                    {"target.en.ceName": {"$regex": f".*{normalized_search_name}.*", "$options": "i"}},
-                    {"target.zh.ceName": {"$regex": f".*{normalized_search_name}.*", "$options": "i"}},
-                ]
-            }
-        },
+        {"$match": {"$or": [{field: {"$regex": combined_pattern, "$options": "i"}} for field in MEDIA_NAME_FIELDS]}},
+        # The n-grams are internal, keep them out of the results and the cache
+        {"$project": {SEARCH_NGRAMS_FIELD: 0}},
+
+        # Tag each target with the names it matches
+        {"$addFields": {MATCHED_PATTERNS_FIELD: get_matched_patterns_expression(target_name_texts, list(patterns))}},
+        {"$unwind": f"${MATCHED_PATTERNS_FIELD}"},
         
-        # Regroup documents with same _id
+        # Regroup documents with same _id, once per matched name
         {
             "$group": {
-                "_id": "$_id",
+                "_id": {"_id": "$_id", "pattern": f"${MATCHED_PATTERNS_FIELD}"},
                 "doc": {"$first": "$$ROOT"}
             }
         },
@@ -46,67 +87,61 @@ async def get_adverse_media(collection, name: str) -> List[Dict]:
     
     cursor = await collection.aggregate(pipeline)
     
-    result = []
+    items = []
+    # Target names of all candidates with the search name they are scored against
+    target_names = []
+    target_owners = []
     
-    print(f"Starting cursor iteration for name: {name}")
     count = 0
     async for item in cursor:
         count += 1
-        print(f"Processing item #{count}")
-        print(f'Checking item: {json.dumps(item.get("target"), indent=2)}')
+        if sample_debug(logger):
+            logger.debug("Checking item #%d: %s", count, LazyJson(item.get("target")))
 
-        if item.get('target', {}).get('name_en'):
-            print('Comparing strings:', {
-                'search_name': normalized_search_name,
-                'target_name': item['target']['name_en'].lower(),
-            })
-            
-            similarities = get_similarities(
-                normalized_search_name,
-                [item['target']['name_en'].lower()],
-                case_sensitive=False,
-                order_sensitive=False,
-                threshold=20,
-                threshold_type='>='
-            )
-            
-            print(f'Similarity results: {similarities}')
-            
-            if similarities:
-                print(f'Found match! Similarity: {similarities[0]}')
-                result.append(item)
-                continue
+        search_name = patterns[item.pop(MATCHED_PATTERNS_FIELD)]
+        name_field, names_field = ('name_zh', 'zh') if search_name in search_bigrams else ('name_en', 'en')
+        if item.get('target', {}).get(name_field):
+            target_names.append((search_name, item['target'][name_field].lower()))
+            target_owners.append(len(items))
 
         # Check second format
-        if item.get('target', {}).get('en'):
-            print(f'Checking second format: {json.dumps(item["target"]["en"], indent=2)}')
-
-            for target in item['target']['en']:
-                print('Comparing strings:', {
-                    'search_name': normalized_search_name,
-                    'target_name': target['ceName'].lower(),
-                })
-                
-                similarities = get_similarities(
-                    normalized_search_name,
-                    [target['ceName'].lower()],
-                    case_sensitive=False,
-                    order_sensitive=False,
-                    threshold=20,
-                    threshold_type='>='
-                )
-                
-                if similarities:
-                    print(f'Found match! Similarity: {similarities[0]}')
-                    result.append(item)
-                    break
-
-    print(f"Processed {count} items from cursor")
-    print(f'After similarity filtering: {len(result)} records')
-    
+        if item.get('target', {}).get(names_field):
+            for target in item['target'][names_field]:
+                target_names.append((search_name, target['ceName'].lower()))
+                target_owners.append(len(items))
+        
+        items.append((search_name, item))
+
+    matched_items = set()
+    english = [choice_index for choice_index, (search_name, _) in enumerate(target_names) if search_name not in search_bigrams]
+    # get_similarities scored case-insensitive comparisons with plain ratio, keep that rule
+    scores = get_pairwise_similarities(
+        [target_names[choice_index][0] for choice_index in english],
+        [target_names[choice_index][1] for choice_index in english],
+        case_sensitive=False,
+        order_sensitive=True,
+        threshold=20
+    )
+    matched_items.update(target_owners[english[position]] for position in np.flatnonzero(scores >= 20))
+    for choice_index, (search_name, target_name) in enumerate(target_names):
+        if search_name in search_bigrams and get_cjk_similarity_hits(search_bigrams[search_name], [get_cjk_bigrams(target_name)]):
+            matched_items.add(target_owners[choice_index])
+
+    for item_index in sorted(matched_items):
+        search_name, item = items[item_index]
+        results[search_name].append(item)
+
+    logger.debug("Processed %d items from cursor for %d names", count, len(patterns))
+    logger.debug('After similarity filtering: %s', LazyJson({search_name: len(result) for search_name, result in results.items()}))
+    return results
+
+async def get_adverse_media_candidates(collection, name: str) -> List[Dict]:
+    results = await get_adverse_media_candidates_by_name(collection, [name])
+    return results.get(normalize_screening_name(name), [])
+
+def format_adverse_media(result: List[Dict]) -> List[Dict]:
     formatted_data = []
     for item in result:
-        print(f"Formatting item: {item['_id']}")
         subtitle = item['source']['title']
         if item.get('published'):
             subtitle += f" - {item['published']}"
@@ -118,29 +153,72 @@ async def get_adverse_media(collection, name: str) -> List[Dict]:
             'subtitle': subtitle,
             'description': item.get('content', {}).get('en'),
         }
-        print(f"Formatted item: {json.dumps(formatted_item, indent=2)}")
+        if sample_debug(logger):
+            logger.debug("Formatted item: %s", LazyJson(formatted_item))
         formatted_data.append(formatted_item)
 
-    print(f"Final formatted data count: {len(formatted_data)}")
+    logger.debug("Final formatted data count: %d", len(formatted_data))
     return formatted_data
 
-async def handler(client: AsyncMongoClient, search_name: list[str]) -> Dict[str, Any]:
+async def get_adverse_media(collection, name: str) -> List[Dict]:
+    return format_adverse_media(await get_adverse_media_candidates(collection, name))
+
+async def handler(client: AsyncMongoClient, search_name: list[str], concurrency: int|None = None, batch_size: int|None = None) -> Dict[str, Any]:
     
     # Array of names to search
     name_to_search_arr = search_name
+    concurrency = concurrency or int(os.getenv('SEARCH_CONCURRENCY', '4'))
+    batch_size = batch_size or int(os.getenv('SEARCH_BATCH_SIZE', '50'))
 
     try:
         db = client[os.getenv('SOURCE_DATABASE_NAME')]
         collection = db[os.getenv('MEDIA_COLLECTION_NAME')]
+        semaphore = asyncio.Semaphore(concurrency)
+        cache = get_screening_cache()
+
+        async def search(names: List[str]) -> Dict[str, List[Dict]]:
+            async with semaphore:
+                try:
+                    results = await get_adverse_media_candidates_by_name(collection, names)
+                except Exception as error:
+                    logger.error('Error searching for adverse media with names %s: %s', names, error)
+                    results = None
+            if results is None:
+                if len(names) == 1:
+                    return {}
+                # One name can fail the aggregation of its batch, the others are searched on their own
+                results = {}
+                for name_results in await asyncio.gather(*[search([name]) for name in names]):
+                    results.update(name_results)
+                return results
+            for normalized_search_name, items in results.items():
+                cache.set(('adverse media', normalized_search_name), items)
+            return results
+
+        # Drop the screenings changed since the last request, as published by the changelog jobs
+        await sync_screening_cache(get_screening_invalidation_collection(db))
 
-        data = []
+        # Names not cached are searched with one aggregation per batch, batches run concurrently
+        results = {}
+        uncached = []
         for name in name_to_search_arr:
-            try:
-                results = await get_adverse_media(collection, name)
-                data.extend(results)
-            except Exception as error:
-                print(f'Error searching for adverse media with name {name}: {error}')
-                continue
+            cached = cache.get(('adverse media', normalize_screening_name(name)))
+            if cached is None:
+                uncached.append(name)
+            else:
+                results[normalize_screening_name(name)] = cached
+        batches = [uncached[start:start + batch_size] for start in range(0, len(uncached), batch_size)]
+        for batch_results in await asyncio.gather(*[search(batch) for batch in batches]):
+            results.update(batch_results)
+
+        # An article matched by several names is kept once, in the order of the names
+        candidates = {}
+        for name in name_to_search_arr:
+            for item in results.get(normalize_screening_name(name), []):
+                candidates.setdefault(item['_id'], item)
+
+        data = format_adverse_media(list(candidates.values()))
+        logger.debug('Screening cache: %s', cache.stats())
 
         return {
             'statusCode': 200,
@@ -151,7 +229,7 @@ async def handler(client: AsyncMongoClient, search_name: list[str]) -> Dict[str,
             })
         }
     except Exception as error:
-        print(f'Adverse media search failed: {error}')
+        logger.error('Adverse media search failed: %s', error)
         return {
             'statusCode': 500,
             'body': json.dumps({
@@ -0,0 +1,120 @@
+import os
+import socket
+import logging
+from datetime import datetime
+from typing import AsyncIterator
+from uuid import uuid4
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+# Claiming protocol for running several monitoring workers on the same changelogs.
+# A worker leases a page of changelogs by moving them from pending to processing under a
+# lease id with an expiry. Once the page is written, matched changelogs become completed and
+# the others go back to pending, stamped with the time they were scanned so that no worker
+# of the same pass claims them again. Leases of crashed workers expire and are claimed again.
+# Lease and scan times are the server's ($$NOW), so the clocks of the workers do not matter.
+LEASE_ID_FIELD = "lease_id"
+LEASE_OWNER_FIELD = "lease_owner"
+LEASE_EXPIRES_FIELD = "lease_expires_at"
+SCANNED_AT_FIELD = "scanned_at"
+LEASE_FIELDS = {LEASE_ID_FIELD: "", LEASE_OWNER_FIELD: "", LEASE_EXPIRES_FIELD: ""}
+
+class LeaseLostError(Exception):
+    """
+    Raised when changelogs of a lease were claimed by another worker after the lease expired
+    """
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+async def get_server_time(collection) -> datetime:
+    hello = await collection.database.command("hello")
+    return hello["localTime"]
+
+def get_claimable_condition(scan_started_at: datetime) -> dict:
+    """
+    Pending changelogs not scanned since scan_started_at, a server time, and expired leases
+    """
+    return {
+        "$or": [
+            {"status": "pending", "$or": [{SCANNED_AT_FIELD: {"$exists": False}}, {SCANNED_AT_FIELD: {"$lt": scan_started_at}}]},
+            {"status": "processing", "$expr": {"$lt": [f"${LEASE_EXPIRES_FIELD}", "$$NOW"]}},
+        ]
+    }
+
+async def claim_changelogs(collection, owner: str, batch_size: int, lease_seconds: float, scan_started_at: datetime, projection: dict|None = None) -> tuple[ObjectId|None, list[dict]]:
+    """
+    Lease up to batch_size claimable changelogs, in _id order.
+
+    Returns:
+        The lease id and the changelogs this worker won, which may be fewer than the
+        candidates when other workers claim them at the same time. The lease id is None
+        when nothing is left to claim.
+    """
+    claimable = get_claimable_condition(scan_started_at)
+    candidates = await collection.find(claimable, {"_id": 1}, sort=[("_id", 1)], limit=batch_size).to_list()
+    if not candidates:
+        return None, []
+
+    lease_id = ObjectId()
+    # Each document is only updated while it is still claimable, so one worker wins it
+    await collection.update_many(
+        {"_id": {"$in": [candidate["_id"] for candidate in candidates]}, **claimable},
+        [{"$set": {
+            "status": "processing",
+            LEASE_ID_FIELD: lease_id,
+            LEASE_OWNER_FIELD: {"$literal": owner},
+            LEASE_EXPIRES_FIELD: {"$add": ["$$NOW", int(lease_seconds * 1000)]},
+        }}]
+    )
+    changelogs = await collection.find({LEASE_ID_FIELD: lease_id}, projection, sort=[("_id", 1)]).to_list()
+    return lease_id, changelogs
+
+async def claim_changelog_pages(collection, batch_size: int = 1000, lease_seconds: float = 300, projection: dict|None = None, owner: str|None = None) -> AsyncIterator[tuple[ObjectId, list[dict]]]:
+    """
+    Lease pages of changelogs until none is left to claim in this pass
+    """
+    owner = owner or get_worker_id()
+    scan_started_at = await get_server_time(collection)
+    while True:
+        lease_id, changelogs = await claim_changelogs(collection, owner, batch_size, lease_seconds, scan_started_at, projection)
+        if lease_id is None:
+            return
+        if changelogs:
+            logger.info("Worker %s leased %d changelogs", owner, len(changelogs))
+            yield lease_id, changelogs
+
+async def renew_lease(collection, lease_id: ObjectId, changelog_count: int, lease_seconds: float):
+    """
+    Extend the lease of a page waiting in the pipeline, so that it does not expire before
+    it is written. Raises LeaseLostError when some of its changelogs were claimed again.
+    """
+    result = await collection.update_many(
+        {LEASE_ID_FIELD: lease_id},
+        [{"$set": {LEASE_EXPIRES_FIELD: {"$add": ["$$NOW", int(lease_seconds * 1000)]}}}]
+    )
+    if result.matched_count < changelog_count:
+        raise LeaseLostError(f"Lease {lease_id} lost {changelog_count - result.matched_count} of {changelog_count} changelogs")
+
+async def check_lease(collection, lease_id: ObjectId, changelog_ids: list, session=None):
+    held = await collection.count_documents({"_id": {"$in": changelog_ids}, LEASE_ID_FIELD: lease_id}, session=session)
+    if held < len(changelog_ids):
+        raise LeaseLostError(f"Lease {lease_id} lost {len(changelog_ids) - held} of {len(changelog_ids)} changelogs")
+
+async def complete_lease(collection, lease_id: ObjectId, matched_ids: list, session=None):
+    """
+    Mark the matched changelogs of a lease completed and return the others to pending
+    """
+    result = await collection.update_many(
+        {"_id": {"$in": matched_ids}, LEASE_ID_FIELD: lease_id},
+        {"$set": {"status": "completed"}, "$unset": LEASE_FIELDS},
+        session=session
+    )
+    if result.matched_count < len(matched_ids):
+        raise LeaseLostError(f"Lease {lease_id} lost {len(matched_ids) - result.matched_count} of {len(matched_ids)} matched changelogs")
+    await collection.update_many(
+        {LEASE_ID_FIELD: lease_id},
+        [{"$set": {"status": "pending", SCANNED_AT_FIELD: "$$NOW"}}, {"$unset": list(LEASE_FIELDS)}],
+        session=session
+    )
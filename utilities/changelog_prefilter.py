@@ -0,0 +1,142 @@
+import logging
+import re
+from typing import Dict, List, Optional, Set
+from utilities.name_index import build_name_index, get_ngrams
+from utilities.search_index import as_string_array
+
+logger = logging.getLogger(__name__)
+
+# Server-side prefilter of pending changelogs. Every watchlist name is keyed on one n-gram
+# it always contains, chosen like its blocking key in build_name_index, so a changelog can
+# only match when one of its target names, or its title, contains one of those keys.
+# The keys are sent in chunks of $in lists, the changelog n-grams are computed by the aggregation.
+
+PREFILTER_CHUNK_SIZE = 10000
+PREFILTER_EN_NGRAM_SIZE = 8
+PREFILTER_ZH_NGRAM_SIZE = 2
+
+# Regex names the prefilter cannot derive a required substring from
+UNFILTERABLE_REGEX_CHARS = set("|*?{}[]\\")
+
+# $toLower only lowercases ASCII letters, where the matching uses str.lower(). Texts with a
+# non-ASCII character str.lower() changes (uppercase and titlecase letters, Roman numerals
+# and circled letters) are kept, their server-side n-grams may miss a key.
+NON_ASCII_UPPERCASE_PATTERN = r"(?![A-Z])[\p{Lu}\p{Lt}\x{2160}-\x{216F}\x{24B6}-\x{24CF}]"
+
+def get_required_literal_key(name: str, n: int) -> Optional[str]:
+    """
+    An n-gram every match of re.search(f".*{name}.*", text) contains, for names whose only
+    regex characters are . ^ $ ( ) +, None for other patterns
+    """
+    if UNFILTERABLE_REGEX_CHARS.intersection(name):
+        return None
+    literals = [literal for literal in re.split(r"[.^$()+]", name) if literal]
+    if not literals:
+        return None
+    longest = max(literals, key=len)
+    return min(get_ngrams(longest, n))
+
+def get_prefilter_keys(watchlist: dict, en_ngram_size: int = PREFILTER_EN_NGRAM_SIZE) -> Optional[Dict[str, Set[str]]]:
+    """
+    Keys of the watchlist names, by language. English names are keyed on longer n-grams
+    than the in-memory index, which are far more selective against the changelogs.
+    Chinese names keep bigram keys: the bigram matching only guarantees those.
+    None when a name has no key the prefilter can test, then every changelog is a candidate.
+    """
+    keys = {}
+    for language, n in (("en", en_ngram_size), ("zh", PREFILTER_ZH_NGRAM_SIZE)):
+        names = watchlist[f"name_{language}_list"]
+        index = build_name_index(names, n)
+        language_keys = set(index["keys"])
+        for position in index["unindexed"]:
+            key = get_required_literal_key(names[position], n)
+            if key is None:
+                logger.warning("Watchlist name %r cannot be prefiltered, prefilter disabled", names[position])
+                return None
+            language_keys.add(key)
+        keys[language] = language_keys
+    return keys
+
+def ngrams_expression(texts: dict, lengths: List[int]) -> dict:
+    # All substrings of the given lengths of every text, like get_ngrams over each of them
+    return {
+        "$reduce": {
+            "input": texts,
+            "initialValue": [],
+            "in": {
+                "$concatArrays": ["$$value"] + [
+                    {
+                        "$map": {
+                            "input": {"$range": [0, {"$max": [1, {"$subtract": [{"$strLenCP": "$$this"}, length - 1]}]}]},
+                            "as": "start",
+                            "in": {"$substrCP": ["$$this", "$$start", length]},
+                        }
+                    }
+                    for length in lengths
+                ]
+            },
+        }
+    }
+
+def build_prefilter_pipeline(condition: dict, en_keys: List[str], zh_keys: List[str]) -> List[dict]:
+    """
+    Aggregation returning the _id of the changelogs matching condition that contain one
+    of the keys, the way get_changelog_names and match_changelog_names read them:
+    English names and titles lowercased, Chinese names as they are
+    """
+    cased_texts = {
+        "$concatArrays": [
+            as_string_array("$new_data.target.name_en"),
+            as_string_array("$new_data.target.en.ceName"),
+            as_string_array("$new_data.title"),
+        ]
+    }
+    en_texts = {"$map": {"input": cased_texts, "in": {"$toLower": "$$this"}}}
+    zh_texts = {
+        "$concatArrays": [
+            as_string_array("$new_data.target.name_zh"),
+            as_string_array("$new_data.target.zh.ceName"),
+            {"$map": {"input": as_string_array("$new_data.title"), "in": {"$toLower": "$$this"}}},
+        ]
+    }
+    key_conditions = [{"non_ascii_uppercase": True}]
+    if en_keys:
+        key_conditions.append({"en_ngrams": {"$in": en_keys}})
+    if zh_keys:
+        key_conditions.append({"zh_ngrams": {"$in": zh_keys}})
+    return [
+        {"$match": condition},
+        {"$project": {
+            "en_ngrams": ngrams_expression(en_texts, sorted({len(key) for key in en_keys}) or [1]),
+            "zh_ngrams": ngrams_expression(zh_texts, sorted({len(key) for key in zh_keys}) or [1]),
+            "non_ascii_uppercase": {
+                "$anyElementTrue": [{
+                    "$map": {
+                        "input": cased_texts,
+                        "in": {"$regexMatch": {"input": "$$this", "regex": NON_ASCII_UPPERCASE_PATTERN}},
+                    }
+                }]
+            },
+        }},
+        {"$match": {"$or": key_conditions}},
+        {"$project": {"_id": 1}},
+    ]
+
+async def prefilter_changelog_ids(collection, condition: dict, keys: Dict[str, Set[str]], chunk_size: int = PREFILTER_CHUNK_SIZE) -> Set:
+    """
+    Return the ids of the changelogs matching condition that may match the watchlist,
+    with one aggregation per chunk of at most chunk_size keys
+    """
+    key_list = [("en", key) for key in sorted(keys["en"])] + [("zh", key) for key in sorted(keys["zh"])]
+    candidate_ids = set()
+    for start in range(0, len(key_list), chunk_size):
+        chunk = key_list[start:start + chunk_size]
+        pipeline = build_prefilter_pipeline(
+            condition,
+            [key for language, key in chunk if language == "en"],
+            [key for language, key in chunk if language == "zh"]
+        )
+        cursor = await collection.aggregate(pipeline)
+        async for document in cursor:
+            candidate_ids.add(document["_id"])
+    return candidate_ids
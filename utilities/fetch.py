@@ -1,7 +1,62 @@
 from pymongo import AsyncMongoClient
+from typing import AsyncIterator
 
-async def fetch(client: AsyncMongoClient, database_name: str, collection_name: str, condition: dict):
+async def fetch(client: AsyncMongoClient, database_name: str, collection_name: str, condition: dict, projection: dict|None = None):
     db = client[database_name]
     collection = db[collection_name]
-    data = await collection.find(condition).to_list()
+    data = await collection.find(condition, projection).to_list()
     return data
+
+async def fetch_batches(
+    client: AsyncMongoClient,
+    database_name: str,
+    collection_name: str,
+    condition: dict,
+    batch_size: int = 1000,
+    projection: dict|None = None,
+    sort: list|None = None
+) -> AsyncIterator[list[dict]]:
+    """
+    Stream the matching documents as lists of at most batch_size documents,
+    so only one batch is held in memory at a time
+    """
+    db = client[database_name]
+    collection = db[collection_name]
+    cursor = collection.find(condition, projection, sort=sort).batch_size(batch_size)
+    try:
+        batch = []
+        async for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        await cursor.close()
+
+async def fetch_pages(
+    client: AsyncMongoClient,
+    database_name: str,
+    collection_name: str,
+    condition: dict,
+    page_size: int = 1000,
+    after=None,
+    projection: dict|None = None
+) -> AsyncIterator[list[dict]]:
+    """
+    Stream the matching documents in _id order as pages of at most page_size documents.
+    Each page is its own query starting after the last _id of the previous one (or after
+    the given _id), so no cursor is held open between pages.
+    """
+    db = client[database_name]
+    collection = db[collection_name]
+    while True:
+        page_condition = {**condition, "_id": {"$gt": after}} if after is not None else condition
+        page = await collection.find(page_condition, projection, sort=[("_id", 1)], limit=page_size).to_list()
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1]["_id"]
@@ -2,68 +2,105 @@ from pymongo import AsyncMongoClient
 from typing import List, Dict, Any
 import os
 import json
-from utilities.text_similarity import get_similarities  # You'll need an equivalent Python package
+import asyncio
+import logging
+import numpy as np
+from utilities.text_similarity import get_pairwise_similarities
+from utilities.search_index import SEARCH_NGRAMS_FIELD, get_search_pattern, get_any_search_ngram_condition, get_matched_patterns_expression, as_string_array
+from utilities.result_cache import get_screening_cache, get_screening_invalidation_collection, normalize_screening_name, sync_screening_cache
+from utilities.log import LazyJson
 
-async def get_judgments(collection, name: str) -> List[Dict]:
-    if not name:
-        return []
-    
-    # Preprocess search name
-    normalized_search_name = name.lower().strip()
-    print(f'Original search name: {name}')
-    print(f'Normalized search name: {normalized_search_name}')
+logger = logging.getLogger(__name__)
+
+MATCHED_PATTERNS_FIELD = "matched_patterns"
+
+async def get_judgments_by_name(collection, names: List[str]) -> Dict[str, List[Dict]]:
+    """
+    Search several names in one aggregation. Every judgment is tagged with the names its
+    title matches, then each title is scored against its names in one pass.
+
+    Returns:
+        Matching judgments by normalized search name, names that are not valid patterns are left out
+    """
+    results = {}
+    # Search pattern -> normalized search name
+    patterns = {}
+    for name in names:
+        # Preprocess search name
+        normalized_search_name = normalize_screening_name(name)
+        if not normalized_search_name or normalized_search_name in results:
+            continue
+        logger.debug('Normalized search name: %s -> %s', name, normalized_search_name)
+        pattern = get_search_pattern(normalized_search_name)
+        if pattern is None:
+            logger.error('Error searching for judgments with name %s: invalid pattern', name)
+            continue
+        results[normalized_search_name] = []
+        patterns[pattern] = normalized_search_name
+
+    if not patterns:
+        return results
 
     # Get candidates with loose conditions
-    pipeline = [
+    pipeline = []
+    search_ngram_condition = get_any_search_ngram_condition(list(patterns.values()))
+    if search_ngram_condition:
+        # Narrow down with the indexed title n-grams
+        pipeline.append({'$match': search_ngram_condition})
+    pipeline += [
         {
             '$match': {
-                'title': {'$regex': f'.*{normalized_search_name}.*', '$options': 'i'}
+                'title': {'$regex': '|'.join(f'(?:{pattern})' for pattern in patterns), '$options': 'i'}
             }
-        }
+        },
+        # The n-grams are internal, keep them out of the results and the cache
+        {'$project': {SEARCH_NGRAMS_FIELD: 0}},
+        # Tag each judgment with the names its title matches
+        {'$addFields': {MATCHED_PATTERNS_FIELD: get_matched_patterns_expression(as_string_array('$title'), list(patterns))}}
     ]
 
-    print(f'Aggregation pipeline: {json.dumps(pipeline, indent=2)}')
+    logger.debug('Aggregation pipeline: %s', LazyJson(pipeline))
     
     candidates = await collection.aggregate(pipeline)
-    # print(f'Found {len(candidates)} candidate records')
 
     # Filter using string similarity
-    result = []
+    items = []
+    search_names = []
+    titles = []
     async for item in candidates:
+        matched_patterns = item.pop(MATCHED_PATTERNS_FIELD, [])
         if isinstance(item.get('title'), str):
-            lower_item_title = item['title'].lower()
             item["_id"] = str(item["_id"])
-            print('Comparing strings:', {
-                'search_name': normalized_search_name,
-                'target_name': lower_item_title
-            })
+            for pattern in matched_patterns:
+                items.append(item)
+                search_names.append(patterns[pattern])
+                titles.append(item['title'].lower())
 
-            similarities = get_similarities(
-                normalized_search_name,
-                [lower_item_title],
-                case_sensitive=False,
-                order_sensitive=False,
-                threshold=20,
-                threshold_type='>='
-            )
+    # get_similarities scored case-insensitive comparisons with plain ratio, keep that rule
+    scores = get_pairwise_similarities(
+        search_names,
+        titles,
+        case_sensitive=False,
+        order_sensitive=True,
+        threshold=20
+    )
 
-            print(f'Similarity results: {similarities}')
+    for choice_index in np.flatnonzero(scores >= 20):
+        results[search_names[choice_index]].append(items[choice_index])
 
-            if similarities:
-                print(f'Found match! Similarity: {similarities[0]}')
-                result.append(item)
+    logger.debug('After similarity filtering: %s', LazyJson({search_name: len(result) for search_name, result in results.items()}))
+    return results
 
-    print(f'After similarity filtering: {len(result)} records')
-    
-    if result:
-        print(f'First record: {json.dumps(result[0], indent=2)}')
-
-    return result
+async def get_judgments(collection, name: str) -> List[Dict]:
+    results = await get_judgments_by_name(collection, [name])
+    return results.get(normalize_screening_name(name), [])
 
-async def handler(client: AsyncMongoClient, search_name:list[str]) -> Dict[str, Any]:
-    print(f'Received search_name: {search_name}')
+async def handler(client: AsyncMongoClient, search_name:list[str], concurrency: int|None = None, batch_size: int|None = None) -> Dict[str, Any]:
+    logger.debug('Received search_name: %s', search_name)
 
     name_to_search_arr = search_name
+    concurrency = concurrency or int(os.getenv('SEARCH_CONCURRENCY', '4'))
+    batch_size = batch_size or int(os.getenv('SEARCH_BATCH_SIZE', '50'))
 
     if not name_to_search_arr:
         return {
@@ -77,14 +114,52 @@ async def handler(client: AsyncMongoClient, search_name:list[str]) -> Dict[str,
         db = client[os.getenv('SOURCE_DATABASE_NAME')]
         collection = db[os.getenv('JUDGMENT_COLLECTION_NAME')]
 
-        data = []
+        semaphore = asyncio.Semaphore(concurrency)
+        cache = get_screening_cache()
+
+        async def search(names: List[str]) -> Dict[str, List[Dict]]:
+            async with semaphore:
+                try:
+                    results = await get_judgments_by_name(collection, names)
+                except Exception as error:
+                    logger.error('Error searching for judgments with names %s: %s', names, error)
+                    results = None
+            if results is None:
+                if len(names) == 1:
+                    return {}
+                # One name can fail the aggregation of its batch, the others are searched on their own
+                results = {}
+                for name_results in await asyncio.gather(*[search([name]) for name in names]):
+                    results.update(name_results)
+                return results
+            for normalized_search_name, items in results.items():
+                cache.set(('judgment', normalized_search_name), items)
+            return results
+
+        # Drop the screenings changed since the last request, as published by the changelog jobs
+        await sync_screening_cache(get_screening_invalidation_collection(db))
+
+        # Names not cached are searched with one aggregation per batch, batches run concurrently
+        results = {}
+        uncached = []
+        for name in name_to_search_arr:
+            cached = cache.get(('judgment', normalize_screening_name(name)))
+            if cached is None:
+                uncached.append(name)
+            else:
+                results[normalize_screening_name(name)] = cached
+        batches = [uncached[start:start + batch_size] for start in range(0, len(uncached), batch_size)]
+        for batch_results in await asyncio.gather(*[search(batch) for batch in batches]):
+            results.update(batch_results)
+
+        # A judgment matched by several names is kept once, in the order of the names
+        judgments = {}
         for name in name_to_search_arr:
-            try:
-                results = await get_judgments(collection, name)
-                data.extend(results)
-            except Exception as error:
-                print(f'Error searching for judgments with name {name}: {error}')
-                continue
+            for item in results.get(normalize_screening_name(name), []):
+                judgments.setdefault(item['_id'], item)
+
+        data = list(judgments.values())
+        logger.debug('Screening cache: %s', cache.stats())
 
         return {
             'statusCode': 200,
@@ -95,7 +170,7 @@ async def handler(client: AsyncMongoClient, search_name:list[str]) -> Dict[str,
             })
         }
     except Exception as error:
-        print(f'Judgment search failed: {error}')
+        logger.error('Judgment search failed: %s', error)
         return {
             'statusCode': 500,
             'body': json.dumps({
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import random
+from datetime import datetime
+
+_sample_rate = 1.0
+
+class LazyJson:
+    """
+    Defer json.dumps of a payload until a log record is actually emitted
+    """
+    def __init__(self, value, indent: int|None = 2):
+        self.value = value
+        self.indent = indent
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, indent=self.indent, default=str, ensure_ascii=False)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def configure_logging():
+    """
+    Configure logging from the environment.
+
+    LOG_LEVEL: Root level, INFO by default
+    LOG_LEVELS: Per-module levels, e.g. "utilities.judgment=DEBUG,aml_ongoing_mon=WARNING"
+    LOG_FORMAT: "text" (default) or "json" for one JSON object per line
+    LOG_SAMPLE_RATE: Fraction of per-comparison debug lines to emit, 1 by default
+    """
+    global _sample_rate
+
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[handler], force=True)
+
+    for module_level in os.getenv("LOG_LEVELS", "").split(","):
+        if "=" in module_level:
+            module, level = module_level.split("=", 1)
+            logging.getLogger(module.strip()).setLevel(level.strip().upper())
+
+    _sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+
+def sample_debug(logger: logging.Logger) -> bool:
+    """
+    Whether a per-comparison debug line should be logged, checked before any formatting
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return _sample_rate >= 1 or random.random() < _sample_rate
@@ -0,0 +1,246 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import AsyncIterator, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Metrics of one run of a job: seconds per stage, counters and histograms. The metrics of
+# the running job are held in a context variable, which the tasks and threads a run starts
+# inherit, so the code of a job records into them without passing them around, and the two
+# jobs of the service keep their own. At the end of a run they are written to METRICS_DIR
+# as <job>.prom, for the node exporter textfile collector, and <job>.json.
+
+METRIC_PREFIX = "aml_ongoing"
+DEFAULT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # Values above the last bucket only count in +Inf
+        position = bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            self.counts[position] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list[int]:
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def stats(self) -> dict:
+        return {
+            "buckets": dict(zip((format_number(bound) for bound in self.buckets), self.cumulative_counts())),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+class Metrics:
+    def __init__(self, job: str):
+        self.job = job
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.duration_seconds = None
+        self.success = None
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {"errors": 0}
+        self.histograms = {}
+        self._started_at = time.perf_counter()
+
+    def add_time(self, stage: str, seconds: float):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started_at)
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, values: Iterable[float], buckets: Iterable[float] = DEFAULT_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        for value in values:
+            histogram.observe(value)
+
+    def finish(self, success: bool):
+        self.success = success
+        self.finished_at = datetime.now()
+        self.duration_seconds = time.perf_counter() - self._started_at
+
+    def stats(self) -> dict:
+        return {
+            "job": self.job,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration_seconds": self.duration_seconds,
+            "success": self.success,
+            "stages": {
+                stage: {"seconds": seconds, "calls": self.stage_calls[stage]}
+                for stage, seconds in self.stage_seconds.items()
+            },
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.stats() for name, histogram in self.histograms.items()},
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text format. They describe the last run, so counters
+        are exported as gauges.
+        """
+        job = f'job="{escape_label(self.job)}"'
+        lines = []
+
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+
+        def sample(name: str, labels: str, value: float):
+            lines.append(f"{METRIC_PREFIX}_{name}{{{labels}}} {format_number(value)}")
+
+        family("last_run_timestamp_seconds", "gauge", "End of the last run, in seconds since the epoch")
+        sample("last_run_timestamp_seconds", job, (self.finished_at or datetime.now()).timestamp())
+        family("last_run_duration_seconds", "gauge", "Duration of the last run")
+        sample("last_run_duration_seconds", job, self.duration_seconds or 0)
+        family("last_run_success", "gauge", "1 when the last run finished without error")
+        sample("last_run_success", job, 1 if self.success else 0)
+
+        family("stage_seconds", "gauge", "Seconds spent per stage in the last run")
+        for stage, seconds in sorted(self.stage_seconds.items()):
+            sample("stage_seconds", f'{job},stage="{escape_label(stage)}"', seconds)
+        family("stage_calls", "gauge", "Times each stage ran in the last run")
+        for stage, calls in sorted(self.stage_calls.items()):
+            sample("stage_calls", f'{job},stage="{escape_label(stage)}"', calls)
+
+        for name, value in sorted(self.counters.items()):
+            family(name, "gauge", f"{name.replace('_', ' ').capitalize()} in the last run")
+            sample(name, job, value)
+
+        for name, histogram in sorted(self.histograms.items()):
+            family(name, "histogram", f"{name.replace('_', ' ').capitalize()} in the last run")
+            for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                sample(f"{name}_bucket", f'{job},le="{format_number(bound)}"', count)
+            sample(f"{name}_bucket", f'{job},le="+Inf"', histogram.count)
+            sample(f"{name}_sum", job, histogram.sum)
+            sample(f"{name}_count", job, histogram.count)
+        return "\n".join(lines) + "\n"
+
+def format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def write_file_atomically(path: str, content: str):
+    # The textfile collector may read at any time, it must never see a partial file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+def export_metrics(metrics: Metrics, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    write_file_atomically(os.path.join(directory, f"{metrics.job}.prom"), metrics.to_prometheus())
+    write_file_atomically(os.path.join(directory, f"{metrics.job}.json"), json.dumps(metrics.stats(), indent=2))
+
+_current_metrics: ContextVar[Optional[Metrics]] = ContextVar("metrics", default=None)
+
+def get_metrics() -> Metrics:
+    """
+    The metrics of the running job, or a throwaway registry outside of record_run
+    """
+    metrics = _current_metrics.get()
+    return metrics if metrics is not None else Metrics("unrecorded")
+
+def start_profiler() -> Optional[cProfile.Profile]:
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as error:
+        # Only one profiler can be active at a time, e.g. when both jobs of the service overlap
+        logger.warning("Profiling disabled for this run: %s", error)
+        return None
+    return profiler
+
+@asynccontextmanager
+async def record_run(job: str) -> AsyncIterator[Metrics]:
+    """
+    Record the metrics of a run of job and export them when it ends.
+
+    METRICS_DIR: Directory of the <job>.prom and <job>.json files, nothing is written when unset
+    METRICS_PROFILE: "true" to also profile the run into <job>.prof, for pstats or snakeviz.
+        Only the event loop thread is profiled, not the match threads and processes.
+    """
+    metrics_dir = os.getenv("METRICS_DIR")
+    profile = bool(metrics_dir) and os.getenv("METRICS_PROFILE", "false").lower() == "true"
+    metrics = Metrics(job)
+    token = _current_metrics.set(metrics)
+    profiler = start_profiler() if profile else None
+    success = False
+    try:
+        yield metrics
+        success = True
+    except BaseException:
+        metrics.inc("errors")
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        metrics.finish(success)
+        _current_metrics.reset(token)
+        logger.info("Run metrics of %s: %s", job, metrics.stage_seconds)
+        if metrics_dir:
+            try:
+                export_metrics(metrics, metrics_dir)
+                if profiler is not None:
+                    profiler.dump_stats(os.path.join(metrics_dir, f"{job}.prof"))
+            except OSError as error:
+                logger.error("Could not write the metrics of %s to %s: %s", job, metrics_dir, error)
+
+def recorded_run(job: str):
+    """
+    Decorate a job's run function to record each of its runs with record_run
+    """
+    def decorate(run):
+        @functools.wraps(run)
+        async def wrapper(*args, **kwargs):
+            async with record_run(job):
+                return await run(*args, **kwargs)
+        return wrapper
+    return decorate
+
+async def time_iterator(iterator: AsyncIterator, stage: str) -> AsyncIterator:
+    """
+    Yield the items of iterator, timing the wait for each of them as stage
+    """
+    metrics = get_metrics()
+    while True:
+        with metrics.timer(stage):
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+        yield item
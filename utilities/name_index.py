@@ -0,0 +1,107 @@
+import re
+from typing import Dict, List, Set, Any
+
+# Characters that make re.compile(f".*{name}.*") behave differently from a plain substring test
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+def get_ngrams(text: str, n: int) -> Set[str]:
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def build_name_index(names: List[str], n: int = 3) -> Dict[str, Any]:
+    """
+    Build a blocking index over watchlist names.
+
+    Each name is stored under its rarest character n-gram. A target can only contain
+    a name as a substring if it also contains every n-gram of that name, so looking up
+    the n-grams of a target returns a superset of the names it contains.
+    Names with regex special characters cannot be blocked this way and are always returned.
+
+    Args:
+        names: Watchlist names, already normalized the same way as the targets
+        n: n-gram length
+
+    Returns:
+        Index dictionary to be used with search_name_index
+    """
+    name_ngrams = {}
+    frequencies = {}
+    unindexed = []
+    for position, name in enumerate(names):
+        if not name:
+            continue
+        if REGEX_SPECIAL_CHARS.intersection(name):
+            unindexed.append(position)
+            continue
+        ngrams = get_ngrams(name, n)
+        name_ngrams[position] = ngrams
+        for ngram in ngrams:
+            frequencies[ngram] = frequencies.get(ngram, 0) + 1
+
+    keys = {}
+    for position, ngrams in name_ngrams.items():
+        key = min(ngrams, key=lambda ngram: (frequencies[ngram], ngram))
+        keys.setdefault(key, []).append(position)
+
+    return {
+        "n": n,
+        "keys": keys,
+        "key_lengths": sorted({len(key) for key in keys}),
+        "unindexed": unindexed,
+    }
+
+def search_name_index(index: Dict[str, Any], text: str) -> Set[int]:
+    """
+    Return the positions of the names that may occur in text
+    """
+    candidates = set(index["unindexed"])
+    if not text:
+        return candidates
+
+    keys = index["keys"]
+    for length in index["key_lengths"]:
+        for i in range(len(text) - length + 1):
+            positions = keys.get(text[i:i + length])
+            if positions:
+                candidates.update(positions)
+    return candidates
+
+def add_to_name_index(index: Dict[str, Any], position: int, name: str):
+    """
+    Index one more name without rebuilding, under the n-gram with the smallest bucket
+    """
+    if not name:
+        return
+    if REGEX_SPECIAL_CHARS.intersection(name):
+        index["unindexed"].append(position)
+        return
+    keys = index["keys"]
+    key = min(get_ngrams(name, index["n"]), key=lambda ngram: (len(keys.get(ngram, ())), ngram))
+    keys.setdefault(key, []).append(position)
+    if len(key) not in index["key_lengths"]:
+        index["key_lengths"] = sorted(set(index["key_lengths"]) | {len(key)})
+
+def remove_from_name_index(index: Dict[str, Any], position: int, name: str):
+    if not name:
+        return
+    if REGEX_SPECIAL_CHARS.intersection(name):
+        if position in index["unindexed"]:
+            index["unindexed"].remove(position)
+        return
+    keys = index["keys"]
+    for ngram in get_ngrams(name, index["n"]):
+        positions = keys.get(ngram)
+        if positions and position in positions:
+            positions.remove(position)
+            if not positions:
+                del keys[ngram]
+            return
+
+def contains_name(text: str, name: str) -> bool:
+    """
+    Same test as re.search(f".*{name}.*", text), without compiling a pattern for plain names
+    """
+    if REGEX_SPECIAL_CHARS.intersection(name):
+        return re.search(f".*{name}.*", text) is not None
+    return name in text
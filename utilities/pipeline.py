@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+async def run_pipeline(
+    source: AsyncIterator[Any],
+    stages: List[Tuple[str, Callable[[Any], Awaitable[Any]]]],
+    queue_size: int = 2
+) -> Dict[str, Dict[str, float]]:
+    """
+    Run the items of source through the stages, each stage in its own task and handing its
+    result to the next one through a queue of at most queue_size items. Stages overlap across
+    items while each keeps their order, and a stage that falls behind makes the previous ones
+    wait instead of buffering. The first error cancels the pipeline and is raised.
+
+    Args:
+        source: Items for the first stage, read by its own task
+        stages: (name, coroutine function) pairs, each called with the previous stage's result
+        queue_size: Items waiting between two stages
+
+    Returns:
+        Per stage, the items processed, the seconds spent in the stage and the seconds it
+        waited for its input
+    """
+    loop = asyncio.get_running_loop()
+    queues = [asyncio.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    stats = {name: {"items": 0, "busy_seconds": 0.0, "idle_seconds": 0.0} for name, _ in stages}
+
+    async def read():
+        async for item in source:
+            await queues[0].put(item)
+        await queues[0].put(_END)
+
+    async def run_stage(position: int):
+        name, stage = stages[position]
+        output = queues[position + 1] if position + 1 < len(stages) else None
+        while True:
+            waited_at = loop.time()
+            item = await queues[position].get()
+            started_at = loop.time()
+            stats[name]["idle_seconds"] += started_at - waited_at
+            if item is _END:
+                break
+            result = await stage(item)
+            stats[name]["busy_seconds"] += loop.time() - started_at
+            stats[name]["items"] += 1
+            if output is not None:
+                await output.put(result)
+        if output is not None:
+            await output.put(_END)
+
+    tasks = [asyncio.create_task(read())] + [asyncio.create_task(run_stage(position)) for position in range(len(stages))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    logger.info("Pipeline stages: %s", stats)
+    return stats
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from utilities.name_index import REGEX_SPECIAL_CHARS
+from utilities.search_index import get_media_names, get_judgment_names
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    """
+    Bounded cache with a time to live and least recently used eviction
+    """
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            del self.entries[key]
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+_screening_cache = None
+
+def get_screening_cache() -> ResultCache:
+    """
+    Process-wide cache of per-name screening results, keyed by (source, normalized name).
+    Sized by SCREENING_CACHE_SIZE and SCREENING_CACHE_TTL_SECONDS, disabled when the size is 0.
+    """
+    global _screening_cache
+    if _screening_cache is None:
+        _screening_cache = ResultCache(
+            max_size=int(os.getenv("SCREENING_CACHE_SIZE", "1024")),
+            ttl_seconds=float(os.getenv("SCREENING_CACHE_TTL_SECONDS", "300"))
+        )
+    return _screening_cache
+
+def normalize_screening_name(name: str) -> str:
+    return name.lower().strip() if name else ""
+
+def get_changelog_screening_names(changelog: dict) -> List[str]:
+    get_names = get_media_names if changelog.get("category") == "adverse media" else get_judgment_names
+    names = []
+    for data in (changelog.get("new_data"), changelog.get("old_data")):
+        if isinstance(data, dict):
+            names.extend(name.lower() for name in get_names(data))
+    return names
+
+def get_touched_screening_names(changelog_data: List[dict]) -> Dict[str, List[str]]:
+    """
+    The new and old target names (or titles) of the ADD, MOD and DEL changelogs, by source
+    """
+    touched: Dict[str, List[str]] = {}
+    for changelog in changelog_data:
+        if changelog.get("action") in ("ADD", "MOD", "DEL"):
+            touched.setdefault(changelog.get("category"), []).extend(get_changelog_screening_names(changelog))
+    return touched
+
+def invalidate_touched_screenings(cache: ResultCache, touched: Dict[str, List[str]]) -> int:
+    """
+    Drop the cached screenings the touched names can change, the way the search regex matches them
+    """
+    if not cache.entries:
+        return 0
+
+    def is_touched(key: Tuple[str, str]) -> bool:
+        source, name = key
+        names = touched.get(source)
+        if not names:
+            return False
+        if REGEX_SPECIAL_CHARS.intersection(name):
+            # The search treats the name as a pattern, be conservative
+            return True
+        return any(name in target_name for target_name in names)
+
+    return cache.invalidate(is_touched)
+
+# The screenings are cached by the API process, the changelogs are read by the jobs. The jobs
+# publish the names their changelogs touch to an invalidation collection, which the handlers
+# read before using their cache. Published invalidations are looked up by the time of their
+# _id, from the previous sync on with a margin for the clock difference between the hosts.
+INVALIDATION_LOOKBACK_SECONDS = 60
+INVALIDATION_TTL_SECONDS = 86400
+
+def get_screening_invalidation_collection(database):
+    return database[os.getenv("SCREENING_INVALIDATION_COLLECTION_NAME", "screening_cache_invalidations")]
+
+async def ensure_screening_invalidation_index(collection):
+    await collection.create_index("createdAt", expireAfterSeconds=INVALIDATION_TTL_SECONDS)
+
+async def publish_screening_invalidation(collection, changelog_data: List[dict]) -> bool:
+    touched = get_touched_screening_names(changelog_data)
+    if not any(touched.values()):
+        return False
+    await collection.insert_one({"names": touched, "createdAt": datetime.now()})
+    return True
+
+class ScreeningInvalidationFeed:
+    """
+    Applies the invalidations published by other processes to a cache, reading them at most
+    once every sync_seconds. Each sync reads from the previous one on, the whole cache is
+    cleared when the invalidations since then may have expired.
+    """
+    def __init__(self, cache: ResultCache, sync_seconds: float = 1):
+        self.cache = cache
+        self.sync_seconds = sync_seconds
+        self.synced_at = None
+        self.last_synced_at = None
+        self.applied = set()
+
+    async def sync(self, collection) -> int:
+        now = time.monotonic()
+        if self.synced_at is not None and now - self.synced_at < self.sync_seconds:
+            return 0
+        self.synced_at = now
+
+        started_at = datetime.now(timezone.utc)
+        dropped = 0
+        if self.last_synced_at is None or started_at - self.last_synced_at > timedelta(seconds=INVALIDATION_TTL_SECONDS):
+            # Nothing tells what changed before, start from an empty cache
+            dropped = len(self.cache.entries)
+            self.cache.clear()
+            self.applied.clear()
+            since = started_at
+        else:
+            since = self.last_synced_at
+        since_id = ObjectId.from_datetime(since - timedelta(seconds=INVALIDATION_LOOKBACK_SECONDS))
+        invalidations = await collection.find({"_id": {"$gte": since_id}}, {"names": 1}).to_list()
+        # Invalidations already applied are remembered for the lookback only
+        self.applied = {_id for _id in self.applied if _id >= since_id}
+        for invalidation in invalidations:
+            if invalidation["_id"] not in self.applied:
+                self.applied.add(invalidation["_id"])
+                dropped += invalidate_touched_screenings(self.cache, invalidation.get("names") or {})
+        self.last_synced_at = started_at
+        return dropped
+
+_screening_invalidation_feed = None
+
+async def sync_screening_cache(collection) -> int:
+    """
+    Apply the published invalidations to the process-wide screening cache, see
+    SCREENING_INVALIDATION_SYNC_SECONDS
+    """
+    global _screening_invalidation_feed
+    if _screening_invalidation_feed is None:
+        _screening_invalidation_feed = ScreeningInvalidationFeed(
+            get_screening_cache(),
+            sync_seconds=float(os.getenv("SCREENING_INVALIDATION_SYNC_SECONDS", "1"))
+        )
+    try:
+        return await _screening_invalidation_feed.sync(collection)
+    except Exception as error:
+        # Entries still expire with their time to live
+        logger.error("Could not read screening cache invalidations: %s", error)
+        return 0
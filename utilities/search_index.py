@@ -0,0 +1,171 @@
+import re
+from pymongo import UpdateOne
+from typing import List, Dict, Callable, Optional
+from utilities.name_index import REGEX_SPECIAL_CHARS, get_ngrams
+
+# Lowercased character n-grams of every searchable name, kept on the source documents
+SEARCH_NGRAMS_FIELD = "search_ngrams"
+SEARCH_NGRAM_SIZE = 2
+# Set on a changelog once the n-grams of its source document were refreshed. Unmatched
+# changelogs stay pending and are read again on every run, they are only refreshed once.
+SEARCH_NGRAMS_REFRESHED_FIELD = "search_ngrams_refreshed"
+
+def get_media_names(document: dict) -> List[str]:
+    # Every value reachable by target.name_en, target.name_zh, target.en.ceName and target.zh.ceName
+    target = document.get("target")
+    items = target if isinstance(target, list) else [target]
+    names = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        names.extend([item.get("name_en"), item.get("name_zh")])
+        for language in ("en", "zh"):
+            entries = item.get(language)
+            entries = entries if isinstance(entries, list) else [entries]
+            names.extend(entry.get("ceName") for entry in entries if isinstance(entry, dict))
+    return [name for name in names if isinstance(name, str) and name]
+
+def get_judgment_names(document: dict) -> List[str]:
+    title = document.get("title")
+    return [title] if isinstance(title, str) and title else []
+
+def build_search_ngrams(names: List[str]) -> List[str]:
+    ngrams = set()
+    for name in names:
+        ngrams.update(get_ngrams(name.lower(), SEARCH_NGRAM_SIZE))
+    return sorted(ngrams)
+
+def get_search_ngram_condition(normalized_search_name: str) -> Optional[Dict]:
+    """
+    Build an indexed condition that returns every document whose names may contain
+    normalized_search_name, including documents that have not been backfilled yet.
+    Returns None when the name cannot be narrowed with n-grams.
+    """
+    if len(normalized_search_name) < SEARCH_NGRAM_SIZE or REGEX_SPECIAL_CHARS.intersection(normalized_search_name):
+        return None
+    return {
+        "$or": [
+            {SEARCH_NGRAMS_FIELD: {"$all": sorted(get_ngrams(normalized_search_name, SEARCH_NGRAM_SIZE))}},
+            {SEARCH_NGRAMS_FIELD: {"$exists": False}},
+        ]
+    }
+
+def get_search_pattern(normalized_search_name: str) -> Optional[str]:
+    """
+    The regex a search matches names with, None when the name does not make a valid pattern
+    """
+    pattern = f".*{normalized_search_name}.*"
+    try:
+        re.compile(pattern)
+    except re.error:
+        return None
+    return pattern
+
+def get_any_search_ngram_condition(normalized_search_names: List[str]) -> Optional[Dict]:
+    """
+    Like get_search_ngram_condition, for documents whose names may contain any of the names.
+    Returns None when one of them cannot be narrowed with n-grams.
+    """
+    alternatives = []
+    for normalized_search_name in normalized_search_names:
+        condition = get_search_ngram_condition(normalized_search_name)
+        if condition is None:
+            return None
+        alternatives.append(condition["$or"][0])
+    if not alternatives:
+        return None
+    return {"$or": alternatives + [{SEARCH_NGRAMS_FIELD: {"$exists": False}}]}
+
+def as_string_array(expression) -> dict:
+    # A path may resolve to a string, an array or nothing depending on the document shape
+    return {
+        "$filter": {
+            "input": {"$cond": [{"$isArray": [expression]}, expression, [expression]]},
+            "cond": {"$eq": [{"$type": "$$this"}, "string"]},
+        }
+    }
+
+def get_matched_patterns_expression(texts: dict, patterns: List[str]) -> dict:
+    """
+    Aggregation expression listing the patterns that match at least one of texts,
+    case-insensitively, to tag each document of a multi-name search with its names
+    """
+    return {
+        "$filter": {
+            "input": {"$literal": patterns},
+            "as": "pattern",
+            "cond": {
+                "$anyElementTrue": [{
+                    "$map": {
+                        "input": texts,
+                        "as": "text",
+                        "in": {"$regexMatch": {"input": "$$text", "regex": "$$pattern", "options": "i"}},
+                    }
+                }]
+            },
+        }
+    }
+
+async def ensure_search_index(collection):
+    await collection.create_index(SEARCH_NGRAMS_FIELD)
+
+async def write_search_ngrams(collection, documents: List[dict], get_names: Callable[[dict], List[str]]) -> int:
+    # The unordered writes of one _id would land in any order, the last version of a document wins
+    latest = {document["_id"]: document for document in documents}
+    operations = [
+        UpdateOne({"_id": _id}, {"$set": {SEARCH_NGRAMS_FIELD: build_search_ngrams(get_names(document))}})
+        for _id, document in latest.items()
+    ]
+    if not operations:
+        return 0
+    result = await collection.bulk_write(operations, ordered=False)
+    return result.modified_count
+
+async def backfill_search_ngrams(collection, get_names: Callable[[dict], List[str]], rebuild: bool = False, batch_size: int = 1000) -> int:
+    """
+    Compute search n-grams for the documents of a collection.
+    Only documents without the field are processed unless rebuild is set.
+    """
+    condition = {} if rebuild else {SEARCH_NGRAMS_FIELD: {"$exists": False}}
+    projection = {"target": 1, "title": 1}
+    cursor = collection.find(condition, projection).batch_size(batch_size)
+    modified = 0
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            modified += await write_search_ngrams(collection, batch, get_names)
+            batch = []
+    modified += await write_search_ngrams(collection, batch, get_names)
+    return modified
+
+async def refresh_search_ngrams(collections: Dict[str, object], changelog_data: List[dict]) -> int:
+    """
+    Recompute search n-grams for the source documents touched by ADD/MOD changelogs.
+    collections maps a changelog category to its source collection.
+    """
+    get_names_by_category = {
+        "adverse media": get_media_names,
+        "judgment": get_judgment_names,
+    }
+    modified = 0
+    for category, collection in collections.items():
+        documents = [
+            changelog["new_data"] for changelog in changelog_data
+            if changelog.get("category") == category
+            and changelog.get("action") in ("ADD", "MOD")
+            and isinstance(changelog.get("new_data"), dict)
+            and changelog["new_data"].get("_id") is not None
+        ]
+        modified += await write_search_ngrams(collection, documents, get_names_by_category[category])
+    return modified
+
+def get_unrefreshed_changelogs(changelog_data: List[dict]) -> List[dict]:
+    return [changelog for changelog in changelog_data if not changelog.get(SEARCH_NGRAMS_REFRESHED_FIELD)]
+
+async def mark_search_ngrams_refreshed(changelog_collection, changelogs: List[dict]):
+    if changelogs:
+        await changelog_collection.update_many(
+            {"_id": {"$in": [changelog["_id"] for changelog in changelogs]}},
+            {"$set": {SEARCH_NGRAMS_REFRESHED_FIELD: True}}
+        )
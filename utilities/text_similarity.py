@@ -1,5 +1,6 @@
-from rapidfuzz import fuzz
-from typing import List, Optional
+from rapidfuzz import fuzz, process
+from typing import List, Optional, Tuple
+import numpy as np
 
 def get_similarities(
     query: str,
@@ -39,4 +40,162 @@ def get_similarities(
         elif threshold_type == '>' and score > threshold:
             results.append(score)
             
-    return results 
\ No newline at end of file
+    return results
+
+def get_similarity_matrix(
+    queries: List[str],
+    choices: List[str],
+    case_sensitive: bool = True,
+    order_sensitive: bool = True,
+    threshold: float = 0,
+    workers: int = 1
+) -> np.ndarray:
+    """
+    Calculate similarity scores between every query and every choice in one call.
+    
+    Args:
+        queries: Strings to compare against
+        choices: Strings to compare with
+        case_sensitive: Whether comparison should be case-sensitive
+        order_sensitive: Whether word order matters
+        threshold: Scores below this value are not computed and reported as 0
+        workers: Number of threads used for scoring (-1 uses all cores)
+    
+    Returns:
+        Array of shape (len(queries), len(choices)) with similarity scores (0-100)
+    """
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)))
+    
+    return process.cdist(
+        queries,
+        choices,
+        scorer=fuzz.ratio if order_sensitive else fuzz.token_sort_ratio,
+        processor=None if case_sensitive else str.lower,
+        score_cutoff=threshold,
+        dtype=np.float64,
+        workers=workers
+    )
+
+def get_similarity_hits(
+    queries: List[str],
+    choices: List[str],
+    case_sensitive: bool = True,
+    order_sensitive: bool = True,
+    threshold: float = 0,
+    threshold_type: str = '>=',
+    workers: int = 1
+) -> List[Tuple[int, int, float]]:
+    """
+    Calculate similarity scores between every query and every choice and keep the matches.
+    
+    Args:
+        queries: Strings to compare against
+        choices: Strings to compare with
+        case_sensitive: Whether comparison should be case-sensitive
+        order_sensitive: Whether word order matters
+        threshold: Similarity threshold value
+        threshold_type: Threshold comparison type ('>=' or '>')
+        workers: Number of threads used for scoring (-1 uses all cores)
+    
+    Returns:
+        List of (query index, choice index, score) for matches that meet the threshold,
+        ordered by query index then choice index
+    """
+    scores = get_similarity_matrix(queries, choices, case_sensitive, order_sensitive, threshold, workers)
+    
+    if threshold_type == '>':
+        mask = scores > threshold
+    else:
+        mask = scores >= threshold
+        
+    query_indices, choice_indices = np.nonzero(mask)
+    return [
+        (int(query_index), int(choice_index), float(scores[query_index, choice_index]))
+        for query_index, choice_index in zip(query_indices, choice_indices)
+    ]
+
+def get_pairwise_similarities(
+    queries: List[str],
+    choices: List[str],
+    case_sensitive: bool = True,
+    order_sensitive: bool = True,
+    threshold: float = 0,
+    workers: int = 1
+) -> np.ndarray:
+    """
+    Calculate the similarity of each query with the choice at the same position in one call.
+    
+    Args:
+        queries: Strings to compare against
+        choices: Strings to compare with, as many as queries
+        case_sensitive: Whether comparison should be case-sensitive
+        order_sensitive: Whether word order matters
+        threshold: Scores below this value are not computed and reported as 0
+        workers: Number of threads used for scoring (-1 uses all cores)
+    
+    Returns:
+        Array of shape (len(queries),) with similarity scores (0-100)
+    """
+    if not queries:
+        return np.zeros(0)
+    
+    return process.cpdist(
+        queries,
+        choices,
+        scorer=fuzz.ratio if order_sensitive else fuzz.token_sort_ratio,
+        processor=None if case_sensitive else str.lower,
+        score_cutoff=threshold,
+        dtype=np.float64,
+        workers=workers
+    )
+
+# Jaccard similarity a Chinese name needs with a target name that contains all its bigrams.
+# A watchlist name inside a target nine times its length scores about 0.1, the same length
+# limit fuzz.ratio > 20 put on a contained name.
+CJK_JACCARD_CUTOFF = 0.1
+
+def is_cjk_character(character: str) -> bool:
+    # CJK unified ideographs, extension A and compatibility ideographs
+    return "\u4e00" <= character <= "\u9fff" or "\u3400" <= character <= "\u4dbf" or "\uf900" <= character <= "\ufaff"
+
+def get_cjk_bigrams(name: str) -> Optional[frozenset]:
+    """
+    Character bigrams of a Chinese name, None for names with fewer than two CJK characters
+    (empty, single character or non-Chinese names), which are too unspecific to screen on
+    """
+    if not name or sum(1 for character in name if is_cjk_character(character)) < 2:
+        return None
+    return frozenset(name[i:i + 2] for i in range(len(name) - 1))
+
+def get_cjk_similarity_hits(
+    query_bigrams: Optional[frozenset],
+    choice_bigrams: List[Optional[frozenset]],
+    min_overlap: float = 1.0,
+    cutoff: float = CJK_JACCARD_CUTOFF
+) -> List[Tuple[int, float]]:
+    """
+    Score a Chinese name against Chinese target names on character bigrams.
+    
+    Args:
+        query_bigrams: get_cjk_bigrams of the searched name
+        choice_bigrams: get_cjk_bigrams of each target name
+        min_overlap: Share of the query bigrams a target must contain, 1.0 requires all of them
+        cutoff: Minimum Jaccard similarity between the bigram sets
+    
+    Returns:
+        List of (choice index, Jaccard similarity) for the targets that pass both cutoffs
+    """
+    if not query_bigrams:
+        return []
+    hits = []
+    for choice_index, bigrams in enumerate(choice_bigrams):
+        if not bigrams:
+            continue
+        shared = len(query_bigrams & bigrams)
+        if shared < min_overlap * len(query_bigrams):
+            continue
+        similarity = shared / (len(query_bigrams) + len(bigrams) - shared)
+        if similarity >= cutoff:
+            hits.append((choice_index, similarity))
+    return hits
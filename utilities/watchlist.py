@@ -0,0 +1,268 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from datetime import datetime
+from bson import ObjectId
+from utilities.fetch import fetch
+from utilities.name_index import build_name_index, add_to_name_index, remove_from_name_index
+from utilities.text_similarity import get_cjk_bigrams
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PROJECTION = {"nameEN": 1, "nameZH": 1, "searchBy": 1}
+SNAPSHOT_PROJECTION = {"nameEN": 1, "nameZH": 1, "searchBy": 1, "ongoing_monitoring": 1, "updatedAt": 1}
+
+# Snapshot file layout: magic, version and metadata length, JSON metadata listing the
+# sections, then the sections themselves at 8-byte aligned offsets. Sections are either
+# raw ObjectId bytes, uint32 arrays, or strings stored as uint32 character offsets plus
+# one UTF-8 blob, so any part of the file can be read straight from a memory map.
+SNAPSHOT_MAGIC = b"AMLWATCH"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sII")
+
+# Reload the compacted snapshot once removed histories make up this share of the watchlist
+SNAPSHOT_COMPACT_RATIO = 0.25
+
+class LazyCJKBigrams:
+    """Bigram sets of the Chinese names, built on first access to a position"""
+
+    def __init__(self, name_zh_history_list: list[str]):
+        self.name_zh_history_list = name_zh_history_list
+        self.bigrams: list = [...] * len(name_zh_history_list)
+
+    def __len__(self) -> int:
+        return len(self.bigrams)
+
+    def __getitem__(self, position: int) -> frozenset[str]|None:
+        bigrams = self.bigrams[position]
+        if bigrams is ...:
+            bigrams = self.bigrams[position] = get_cjk_bigrams(self.name_zh_history_list[position])
+        return bigrams
+
+    def __setitem__(self, position: int, bigrams: frozenset[str]|None):
+        self.bigrams[position] = bigrams
+
+    def append(self, bigrams: frozenset[str]|None):
+        self.bigrams.append(bigrams)
+
+def normalize_history_names(history: dict) -> tuple[str, str]:
+    return history.get("nameEN", "").lower(), history.get("nameZH", "")
+
+def build_watchlist_from_names(name_en_history_list: list[str], name_zh_history_list: list[str]) -> dict:
+    # Index watchlist names once, each changelog then only checks the histories sharing an n-gram with its targets
+    return {
+        "name_en_list": name_en_history_list,
+        "name_zh_list": name_zh_history_list,
+        "zh_bigrams": [get_cjk_bigrams(name_zh) for name_zh in name_zh_history_list],
+        "en_index": build_name_index(name_en_history_list, 3),
+        "zh_index": build_name_index(name_zh_history_list, 2),
+    }
+
+def build_watchlist(history_data: list[dict]) -> dict:
+    names = [normalize_history_names(history) for history in history_data]
+    return build_watchlist_from_names([name_en for name_en, _ in names], [name_zh for _, name_zh in names])
+
+def apply_history_changes(history_data: list[dict|None], watchlist: dict, histories: list[dict]) -> int:
+    """
+    Update the watchlist in place with changed histories. A changed history leaves an empty
+    slot (None in history_data, empty names) and, when still monitored, is appended again.
+
+    Returns:
+        Number of histories added, changed or removed
+    """
+    positions = {history["_id"]: position for position, history in enumerate(history_data) if history is not None}
+    name_en_history_list = watchlist["name_en_list"]
+    name_zh_history_list = watchlist["name_zh_list"]
+    changed = 0
+    for history in histories:
+        position = positions.pop(history["_id"], None)
+        removed = position is not None
+        if removed:
+            remove_from_name_index(watchlist["en_index"], position, name_en_history_list[position])
+            remove_from_name_index(watchlist["zh_index"], position, name_zh_history_list[position])
+            history_data[position] = None
+            name_en_history_list[position] = name_zh_history_list[position] = ""
+            watchlist["zh_bigrams"][position] = None
+        added = history.get("ongoing_monitoring") is True
+        if added:
+            position = len(history_data)
+            name_en, name_zh = normalize_history_names(history)
+            history_data.append({"_id": history["_id"], "searchBy": history.get("searchBy")})
+            name_en_history_list.append(name_en)
+            name_zh_history_list.append(name_zh)
+            watchlist["zh_bigrams"].append(get_cjk_bigrams(name_zh))
+            add_to_name_index(watchlist["en_index"], position, name_en)
+            add_to_name_index(watchlist["zh_index"], position, name_zh)
+            positions[history["_id"]] = position
+        changed += removed or added
+    return changed
+
+def get_latest_update(histories: list[dict], updated_at: datetime|None = None) -> datetime|None:
+    for history in histories:
+        if isinstance(history.get("updatedAt"), datetime) and (updated_at is None or history["updatedAt"] > updated_at):
+            updated_at = history["updatedAt"]
+    return updated_at
+
+def pack_strings(strings: list[str]) -> tuple[array, bytes]:
+    offsets = array("I", [0])
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return offsets, "".join(strings).encode()
+
+def unpack_strings(offsets: array, blob: bytes) -> list[str]:
+    text = blob.decode()
+    return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+def write_watchlist_snapshot(path: str, history_data: list[dict|None], watchlist: dict, updated_at: datetime|None):
+    """
+    Write the watchlist to path, replacing the previous snapshot atomically
+    """
+    sections = {}
+    live = [position for position, history in enumerate(history_data) if history is not None]
+    if len(live) < len(history_data):
+        # Drop the empty slots left by apply_history_changes, renumbering the index postings
+        new_positions = {position: new_position for new_position, position in enumerate(live)}
+        history_data = [history_data[position] for position in live]
+        watchlist = {
+            "name_en_list": [watchlist["name_en_list"][position] for position in live],
+            "name_zh_list": [watchlist["name_zh_list"][position] for position in live],
+            **{
+                name: {
+                    **watchlist[name],
+                    "keys": {key: [new_positions[position] for position in positions] for key, positions in watchlist[name]["keys"].items()},
+                    "unindexed": [new_positions[position] for position in watchlist[name]["unindexed"]],
+                }
+                for name in ("en_index", "zh_index")
+            },
+        }
+
+    sections["ids"] = b"".join(history["_id"].binary for history in history_data)
+    for name, strings in (
+        ("search_by", [history.get("searchBy") or "" for history in history_data]),
+        ("name_en", watchlist["name_en_list"]),
+        ("name_zh", watchlist["name_zh_list"]),
+    ):
+        sections[f"{name}_offsets"], sections[name] = pack_strings(strings)
+    for name in ("en_index", "zh_index"):
+        index = watchlist[name]
+        keys = list(index["keys"])
+        posting_offsets = array("I", [0])
+        postings = array("I")
+        for key in keys:
+            postings.extend(index["keys"][key])
+            posting_offsets.append(len(postings))
+        sections[f"{name}_keys_offsets"], sections[f"{name}_keys"] = pack_strings(keys)
+        sections[f"{name}_posting_offsets"] = posting_offsets
+        sections[f"{name}_postings"] = postings
+        sections[f"{name}_unindexed"] = array("I", index["unindexed"])
+
+    metadata = {
+        "count": len(history_data),
+        "updatedAt": updated_at.isoformat() if updated_at else None,
+        "n": {name: watchlist[name]["n"] for name in ("en_index", "zh_index")},
+        "sections": {},
+    }
+    payloads = [(name, section.tobytes() if isinstance(section, array) else section) for name, section in sections.items()]
+    # Offsets are relative to the end of the header, which depends on the metadata size
+    offset = 0
+    for name, payload in payloads:
+        metadata["sections"][name] = [offset, len(payload)]
+        offset += -(-len(payload) // 8) * 8
+    encoded_metadata = json.dumps(metadata).encode()
+    header_size = -(-(SNAPSHOT_HEADER.size + len(encoded_metadata)) // 8) * 8
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(encoded_metadata)))
+        f.write(encoded_metadata.ljust(header_size - SNAPSHOT_HEADER.size, b"\0"))
+        for _, payload in payloads:
+            f.write(payload.ljust(-(-len(payload) // 8) * 8, b"\0"))
+    os.replace(temporary_path, path)
+
+def read_watchlist_snapshot(path: str) -> tuple[list[dict], dict, datetime|None]|None:
+    """
+    Read a snapshot written by write_watchlist_snapshot, None when it is missing or unreadable
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, metadata_size = SNAPSHOT_HEADER.unpack_from(mm)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                logger.warning("Ignoring watchlist snapshot %s with unknown format", path)
+                return None
+            metadata = json.loads(mm[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + metadata_size])
+            base = -(-(SNAPSHOT_HEADER.size + metadata_size) // 8) * 8
+
+            def read_bytes(name: str) -> bytes:
+                offset, size = metadata["sections"][name]
+                return mm[base + offset:base + offset + size]
+
+            def read_array(name: str) -> array:
+                values = array("I")
+                values.frombytes(read_bytes(name))
+                return values
+
+            def read_strings(name: str) -> list[str]:
+                return unpack_strings(read_array(f"{name}_offsets"), read_bytes(name))
+
+            ids = read_bytes("ids")
+            search_by = read_strings("search_by")
+            history_data = [{"_id": ObjectId(ids[start:start + 12]), "searchBy": value or None} for start, value in zip(range(0, len(ids), 12), search_by)]
+            watchlist = {"name_en_list": read_strings("name_en"), "name_zh_list": read_strings("name_zh")}
+            # Matching only compares the few histories sharing an n-gram with a changelog, leave the rest unbuilt
+            watchlist["zh_bigrams"] = LazyCJKBigrams(watchlist["name_zh_list"])
+            for name in ("en_index", "zh_index"):
+                keys = read_strings(f"{name}_keys")
+                posting_offsets = read_array(f"{name}_posting_offsets")
+                postings = read_array(f"{name}_postings").tolist()
+                watchlist[name] = {
+                    "n": metadata["n"][name],
+                    "keys": {key: postings[posting_offsets[i]:posting_offsets[i + 1]] for i, key in enumerate(keys)},
+                    "key_lengths": sorted({len(key) for key in keys}),
+                    "unindexed": read_array(f"{name}_unindexed").tolist(),
+                }
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logger.warning("Ignoring unreadable watchlist snapshot %s: %s", path, e)
+        return None
+    updated_at = datetime.fromisoformat(metadata["updatedAt"]) if metadata["updatedAt"] else None
+    return history_data, watchlist, updated_at
+
+async def load_watchlist_snapshot(client, database_name: str, collection_name: str, path: str) -> tuple[list[dict|None], dict]:
+    """
+    Load the watchlist from the snapshot at path, refreshed with the histories updated since
+    it was written. The snapshot is rebuilt from scratch when it is missing, when histories
+    have no updatedAt, or when the number of monitored histories no longer adds up (deleted
+    histories leave no updatedAt behind).
+
+    Returns:
+        history_data, with None in the slots of removed histories, and the watchlist
+    """
+    snapshot = read_watchlist_snapshot(path)
+    if snapshot is not None and snapshot[2] is not None:
+        history_data, watchlist, updated_at = snapshot
+        # $gte re-reads the histories of the last snapshot's latest timestamp, which is harmless
+        changed_histories = await fetch(client, database_name, collection_name, {"updatedAt": {"$gte": updated_at}}, SNAPSHOT_PROJECTION)
+        changed = apply_history_changes(history_data, watchlist, changed_histories)
+        live = sum(history is not None for history in history_data)
+        monitored = await client[database_name][collection_name].count_documents({"ongoing_monitoring": True})
+        if live == monitored:
+            if changed:
+                updated_at = get_latest_update(changed_histories, updated_at)
+                write_watchlist_snapshot(path, history_data, watchlist, updated_at)
+                if len(history_data) - live > len(history_data) * SNAPSHOT_COMPACT_RATIO:
+                    # The written snapshot has no empty slots, match against it instead
+                    history_data, watchlist, _ = read_watchlist_snapshot(path)
+            logger.info("Loaded %d watchlist histories from %s, %d changed", live, path, changed)
+            return history_data, watchlist
+        logger.info("Watchlist snapshot %s has %d histories but %d are monitored, rebuilding", path, live, monitored)
+
+    history_data = await fetch(client, database_name, collection_name, {"ongoing_monitoring": True}, SNAPSHOT_PROJECTION)
+    watchlist = build_watchlist(history_data)
+    write_watchlist_snapshot(path, history_data, watchlist, get_latest_update(history_data))
+    history_data = [{"_id": history["_id"], "searchBy": history.get("searchBy")} for history in history_data]
+    logger.info("Built watchlist snapshot %s with %d histories", path, len(history_data))
+    return history_data, watchlist